@@ -7,6 +7,7 @@ import random
 import shutil
 import string
 import tempfile
+import time
 
 from tests import base
 
@@ -123,6 +124,73 @@ class BasicOperationsTestCase(base.TestCase):
 
         Folder().remove(new_folder)
 
+    def test_mapping_registry(self):
+        from girder.plugins.virtual_resources.rest import VirtualObject as vo
+        from girder.plugins.virtual_resources.rest.mappings import mapping_registry
+
+        self.assertEqual(
+            vo.path_from_id(self.public_folder["_id"]),
+            (pathlib.Path(self.public_root), str(self.public_folder["_id"])),
+        )
+
+        new_folder = Folder().createFolder(
+            self.base_collection,
+            random_string(),
+            creator=self.users["sally"],
+            parentType="collection",
+            public=True,
+        )
+        self.assertIsNone(mapping_registry.get(new_folder["_id"]))
+        self.assertIsNone(vo.path_from_id(new_folder["_id"])[0])
+
+        resp = self.request(
+            path="/folder/{_id}".format(**new_folder),
+            method="PUT",
+            user=self.users["admin"],
+            params={"fsPath": self.public_root, "isMapping": True},
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(mapping_registry.get(new_folder["_id"]), self.public_root)
+
+        # Unmapped by another process, without the events of this one
+        Folder().update({"_id": new_folder["_id"]}, {"$unset": {"fsPath": ""}})
+        resp = self.request(
+            path="/folder",
+            method="GET",
+            user=self.users["admin"],
+            params={"parentType": "folder", "parentId": str(new_folder["_id"])},
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json, [])
+        self.assertIsNone(mapping_registry.get(new_folder["_id"]))
+
+        # The registry reloads in the background
+        mapping_registry.update(dict(new_folder, fsPath=self.public_root))
+        resync_interval = mapping_registry.resync_interval
+        mapping_registry.resync_interval = 0
+        try:
+            mapping_registry.get(new_folder["_id"])
+            for _ in range(100):
+                if mapping_registry.get(new_folder["_id"]) is None:
+                    break
+                time.sleep(0.05)
+            self.assertIsNone(mapping_registry.get(new_folder["_id"]))
+        finally:
+            mapping_registry.resync_interval = resync_interval
+
+        Folder().remove(new_folder)
+        self.assertIsNone(mapping_registry.get(new_folder["_id"]))
+
+    def test_fs_path_index(self):
+        indices = Folder().collection.index_information()
+        self.assertIn(
+            {"key": [("fsPath", 1)], "sparse": True},
+            [
+                {"key": index["key"], "sparse": index.get("sparse", False)}
+                for index in indices.values()
+            ],
+        )
+
     def tearDown(self):
         Folder().remove(self.public_folder)
         Collection().remove(self.base_collection)
@@ -1,12 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import hashlib
 import os
 import pathlib
 import random
 import shutil
 import string
 import tempfile
+import time
 
 from tests import base
 
@@ -526,6 +528,420 @@ class FileOperationsTestCase(base.TestCase):
         # self.assertTrue("assetstoreId" in resp.json)  # FIXME!
         # self.assertFalse("sha512" in resp.json)  # FIXME ?
 
+    def test_download_multirange(self):
+        from girder.plugins.virtual_resources.rest import VirtualObject as vo
+
+        root_path = pathlib.Path(self.public_folder["fsPath"])
+        file1 = root_path / "chunks.bin"
+        file1.write_bytes(b"0123456789abcdef")
+        file_id = vo.generate_id(file1, self.public_folder["_id"])
+
+        resp = self.request(
+            path="/file/{}/download".format(file_id),
+            method="GET",
+            user=self.users["sally"],
+            isJson=False,
+            additionalHeaders=[("Range", "bytes=0-1,10-12,-2")],
+        )
+        self.assertStatus(resp, 206)
+        content_type, boundary = resp.headers["Content-Type"].split("; boundary=")
+        self.assertEqual(content_type, "multipart/byteranges")
+        body = self.getBody(resp)
+        self.assertEqual(len(body), int(resp.headers["Content-Length"]))
+        self.assertNotIn("Content-Range", resp.headers)
+
+        parts = body.split("--%s" % boundary)
+        self.assertEqual(parts[0], "")
+        self.assertEqual(parts[-1], "--\r\n")
+        expected = [("0-1", "01"), ("10-12", "abc"), ("14-15", "ef")]
+        for part, (byte_range, data) in zip(parts[1:-1], expected):
+            headers, content = part.split("\r\n\r\n")
+            self.assertIn("Content-Range: bytes %s/16" % byte_range, headers)
+            self.assertEqual(content, data + "\r\n")
+
+        file1.unlink()
+
+    def test_conditional_download(self):
+        from girder.plugins.virtual_resources.rest import VirtualObject as vo
+
+        root_path = pathlib.Path(self.public_folder["fsPath"])
+        file1 = root_path / "cached.bin"
+        file1.write_bytes(b"0123456789")
+        file_id = vo.generate_id(file1, self.public_folder["_id"])
+
+        def download(headers):
+            return self.request(
+                path="/file/{}/download".format(file_id),
+                method="GET",
+                user=self.users["sally"],
+                isJson=False,
+                additionalHeaders=headers,
+            )
+
+        resp = download([])
+        self.assertStatusOk(resp)
+        etag = resp.headers["ETag"]
+        last_modified = resp.headers["Last-Modified"]
+
+        for headers in (
+            [("If-None-Match", etag)],
+            [("If-None-Match", '"other", W/%s' % etag)],
+            [("If-Modified-Since", last_modified)],
+        ):
+            resp = download(headers)
+            self.assertStatus(resp, 304)
+            self.assertEqual(self.getBody(resp), "")
+            self.assertEqual(resp.headers["ETag"], etag)
+
+        # If-None-Match takes precedence over If-Modified-Since
+        resp = download(
+            [("If-None-Match", '"other"'), ("If-Modified-Since", last_modified)]
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(self.getBody(resp), "0123456789")
+
+        # If-Range only applies the range while the file is unchanged
+        resp = download([("Range", "bytes=2-3"), ("If-Range", etag)])
+        self.assertStatus(resp, 206)
+        self.assertEqual(self.getBody(resp), "23")
+
+        file1.write_bytes(b"abcdefghijkl")
+        os.utime(file1.as_posix(), ns=(0, file1.stat().st_mtime_ns + 10 ** 9))
+        resp = download([("Range", "bytes=2-3"), ("If-Range", etag)])
+        self.assertStatusOk(resp)
+        self.assertEqual(self.getBody(resp), "abcdefghijkl")
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+        resp = download([("If-None-Match", etag)])
+        self.assertStatusOk(resp)
+        file1.unlink()
+
+    def test_download_offload(self):
+        from girder.plugins.virtual_resources.constants import PluginSettings
+        from girder.plugins.virtual_resources.rest import VirtualObject as vo
+
+        root_path = pathlib.Path(self.public_folder["fsPath"])
+        file1 = root_path / "big file.bin"
+        file1.write_bytes(b"0123456789")
+        file_id = vo.generate_id(file1, self.public_folder["_id"])
+
+        Setting().set(PluginSettings.SENDFILE_HEADER, "X-Accel-Redirect")
+        Setting().set(PluginSettings.SENDFILE_PREFIX, "/_wt_files/")
+        resp = self.request(
+            path="/file/{}/download".format(file_id),
+            method="GET",
+            user=self.users["sally"],
+            isJson=False,
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(
+            resp.headers["X-Accel-Redirect"],
+            "/_wt_files" + file1.as_posix().replace(" ", "%20"),
+        )
+        self.assertEqual(resp.headers["Content-Type"], "application/octet-stream")
+        self.assertEqual(self.getBody(resp), "")
+
+        # offset/endByte are served by the plugin itself
+        resp = self.request(
+            path="/file/{}/download".format(file_id),
+            method="GET",
+            user=self.users["sally"],
+            isJson=False,
+            params={"offset": 2, "endByte": 5},
+        )
+        self.assertStatus(resp, 206)
+        self.assertNotIn("X-Accel-Redirect", resp.headers)
+        self.assertEqual(self.getBody(resp), "234")
+
+        Setting().set(PluginSettings.SENDFILE_HEADER, "X-Sendfile")
+        resp = self.request(
+            path="/file/{}/download".format(file_id),
+            method="GET",
+            user=self.users["sally"],
+            isJson=False,
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.headers["X-Sendfile"], file1.as_posix())
+
+        resp = self.request(
+            path="/system/setting",
+            method="PUT",
+            user=self.users["admin"],
+            params={"key": PluginSettings.SENDFILE_HEADER, "value": "X-Bogus"},
+        )
+        self.assertStatus(resp, 400)
+
+        Setting().unset(PluginSettings.SENDFILE_HEADER)
+        Setting().unset(PluginSettings.SENDFILE_PREFIX)
+        file1.unlink()
+
+    def test_upload_in_place(self):
+        from girder.plugins.virtual_resources.rest import VirtualObject as vo
+
+        root_path = pathlib.Path(self.private_folder["fsPath"])
+        nested_dir = root_path / "incoming"
+        nested_dir.mkdir()
+        folder_id = vo.generate_id(nested_dir, self.private_folder["_id"])
+        Setting().set(SettingKey.UPLOAD_MINIMUM_CHUNK_SIZE, 0)
+
+        resp = self.request(
+            path="/file",
+            method="POST",
+            user=self.users["sally"],
+            params={
+                "parentType": "folder",
+                "parentId": folder_id,
+                "name": "data.txt",
+                "size": len(chunkData),
+                "mimeType": "text/plain",
+            },
+        )
+        self.assertStatusOk(resp)
+        upload_id = resp.json["_id"]
+        resp = self.request(
+            path="/file/chunk",
+            method="POST",
+            user=self.users["sally"],
+            body=chunk1,
+            params={"offset": 0, "uploadId": upload_id},
+            type="text/plain",
+        )
+        self.assertStatusOk(resp)
+
+        # The upload is written next to its destination, hidden from listings
+        staged = [
+            child for child in nested_dir.iterdir() if child.name.startswith(".wtupload-")
+        ]
+        self.assertEqual(len(staged), 1)
+        self.assertEqual(staged[0].read_bytes(), chunk1.encode("utf8"))
+        inode = staged[0].stat().st_ino
+        resp = self.request(
+            path="/item",
+            method="GET",
+            user=self.users["sally"],
+            params={"folderId": folder_id},
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual([item["name"] for item in resp.json], ["data.txt"])
+
+        resp = self.request(
+            path="/file/offset", user=self.users["sally"], params={"uploadId": upload_id}
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json["offset"], len(chunk1))
+
+        resp = self.request(
+            path="/file/chunk",
+            method="POST",
+            user=self.users["sally"],
+            body=chunk2,
+            params={"offset": len(chunk1), "uploadId": upload_id},
+            type="text/plain",
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json["size"], len(chunkData))
+
+        # Finalized by a rename
+        final = nested_dir / "data.txt"
+        self.assertEqual(sorted(child.name for child in nested_dir.iterdir()), ["data.txt"])
+        self.assertEqual(final.read_bytes(), chunkData)
+        self.assertEqual(final.stat().st_ino, inode)
+        shutil.rmtree(nested_dir.as_posix())
+
+    def test_upload_parallel(self):
+        from girder.plugins.virtual_resources.rest import VirtualObject as vo
+
+        root_path = pathlib.Path(self.private_folder["fsPath"])
+        nested_dir = root_path / "parallel"
+        nested_dir.mkdir()
+        folder_id = vo.generate_id(nested_dir, self.private_folder["_id"])
+        Setting().set(SettingKey.UPLOAD_MINIMUM_CHUNK_SIZE, 0)
+
+        resp = self.request(
+            path="/file",
+            method="POST",
+            user=self.users["sally"],
+            params={
+                "parentType": "folder",
+                "parentId": folder_id,
+                "name": "data.txt",
+                "size": len(chunkData),
+                "mimeType": "text/plain",
+                "parallel": True,
+            },
+        )
+        self.assertStatusOk(resp)
+        upload_id = resp.json["_id"]
+
+        # Chunks may come in any order
+        resp = self.request(
+            path="/file/chunk",
+            method="POST",
+            user=self.users["sally"],
+            body=chunk2,
+            params={"offset": len(chunk1), "uploadId": upload_id},
+            type="text/plain",
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json["received"], len(chunk2))
+
+        resp = self.request(
+            path="/file/offset", user=self.users["sally"], params={"uploadId": upload_id}
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json["offset"], 0)
+        self.assertEqual(
+            resp.json["receivedRanges"], [[len(chunk1), len(chunkData)]]
+        )
+
+        resp = self.request(
+            path="/file/chunk",
+            method="POST",
+            user=self.users["sally"],
+            body=chunk2,
+            params={"offset": len(chunk1) + 1, "uploadId": upload_id},
+            type="text/plain",
+        )
+        self.assertStatus(resp, 400)
+        self.assertEqual(resp.json["message"], "Received too many bytes.")
+
+        resp = self.request(
+            path="/file/chunk",
+            method="POST",
+            user=self.users["sally"],
+            body=chunk1,
+            params={"offset": 0, "uploadId": upload_id},
+            type="text/plain",
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json["name"], "data.txt")
+        self.assertEqual(resp.json["size"], len(chunkData))
+
+        # A retried chunk doesn't reach the finalized file
+        resp = self.request(
+            path="/file/chunk",
+            method="POST",
+            user=self.users["sally"],
+            body=chunk1,
+            params={"offset": 0, "uploadId": upload_id},
+            type="text/plain",
+        )
+        self.assertStatus(resp, 409)
+
+        final = nested_dir / "data.txt"
+        self.assertEqual(sorted(child.name for child in nested_dir.iterdir()), ["data.txt"])
+        self.assertEqual(final.read_bytes(), chunkData)
+        shutil.rmtree(nested_dir.as_posix())
+
+    def test_checksums(self):
+        from girder.plugins.virtual_resources.constants import PluginSettings
+        from girder.plugins.virtual_resources.rest import VirtualObject as vo
+
+        root_path = pathlib.Path(self.public_folder["fsPath"])
+        nested_dir = root_path / "verified"
+        nested_dir.mkdir()
+        contents = {"a.dat": os.urandom(100000), "b.dat": b"checked"}
+        for name, data in contents.items():
+            (nested_dir / name).write_bytes(data)
+        file_id = vo.generate_id(nested_dir / "a.dat", self.public_folder["_id"])
+
+        resp = self.request(
+            path="/file/{}".format(file_id), method="GET", user=self.users["sally"]
+        )
+        self.assertStatusOk(resp)
+        self.assertNotIn("sha256", resp.json)
+
+        resp = self.request(
+            path="/file/{}".format(file_id),
+            method="GET",
+            user=self.users["sally"],
+            params={"checksums": True},
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json["sha256"], hashlib.sha256(contents["a.dat"]).hexdigest())
+        self.assertEqual(resp.json["md5"], hashlib.md5(contents["a.dat"]).hexdigest())
+
+        # Listings include the checksums that are known, and compute the others
+        folder_id = vo.generate_id(nested_dir, self.public_folder["_id"])
+        for _ in range(50):
+            resp = self.request(
+                path="/item",
+                method="GET",
+                user=self.users["sally"],
+                params={"folderId": folder_id, "checksums": True},
+            )
+            self.assertStatusOk(resp)
+            if all("sha256" in item for item in resp.json):
+                break
+            time.sleep(0.1)
+        self.assertEqual(
+            {item["name"]: item["sha256"] for item in resp.json},
+            {name: hashlib.sha256(data).hexdigest() for name, data in contents.items()},
+        )
+
+        # Same for listings served from a mapping index
+        index_root = tempfile.mkdtemp()
+        Setting().set(PluginSettings.INDEX_ROOT, index_root)
+        resp = self.request(
+            path="/virtual_folder/{_id}/index".format(**self.public_folder),
+            method="POST",
+            user=self.users["admin"],
+        )
+        self.assertStatusOk(resp)
+        resp = self.request(
+            path="/item",
+            method="GET",
+            user=self.users["sally"],
+            params={"folderId": folder_id, "checksums": True},
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(
+            {item["name"]: item["md5"] for item in resp.json},
+            {name: hashlib.md5(data).hexdigest() for name, data in contents.items()},
+        )
+        Setting().unset(PluginSettings.INDEX_ROOT)
+        shutil.rmtree(index_root)
+
+        # Listings with checksums are validated by the checksums they show
+        resp = self.request(
+            path="/item",
+            method="GET",
+            user=self.users["sally"],
+            params={"folderId": folder_id, "checksums": True},
+        )
+        self.assertStatusOk(resp)
+        etag = resp.headers["ETag"]
+        resp = self.request(
+            path="/item",
+            method="GET",
+            user=self.users["sally"],
+            params={"folderId": folder_id, "checksums": True},
+            additionalHeaders=[("If-None-Match", etag)],
+            isJson=False,
+        )
+        self.assertStatus(resp, 304)
+
+        # A new version of a file gets new checksums
+        (nested_dir / "a.dat").write_bytes(b"changed")
+        resp = self.request(
+            path="/item",
+            method="GET",
+            user=self.users["sally"],
+            params={"folderId": folder_id, "checksums": True},
+            additionalHeaders=[("If-None-Match", etag)],
+        )
+        self.assertStatusOk(resp)
+        resp = self.request(
+            path="/file/{}".format(file_id),
+            method="GET",
+            user=self.users["sally"],
+            params={"checksums": True},
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json["sha256"], hashlib.sha256(b"changed").hexdigest())
+
+        shutil.rmtree(nested_dir.as_posix())
+
     def tearDown(self):
         # Folder().remove(self.public_folder)
         # Folder().remove(self.private_folder)
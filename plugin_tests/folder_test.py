@@ -1,16 +1,23 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import io
+import json
+import os
 import pathlib
 import shutil
+import sqlite3
+import tarfile
 import tempfile
+import time
 import zipfile
+import zlib
 
 from tests import base
 
 from girder.constants import AccessType
 from girder.models.collection import Collection
 from girder.models.folder import Folder
+from girder.models.setting import Setting
 from girder.models.user import User
 
 
@@ -26,6 +33,10 @@ def tearDownModule():
 class FolderOperationsTestCase(base.TestCase):
     def setUp(self):
         super(FolderOperationsTestCase, self).setUp()
+        from girder.plugins.virtual_resources.constants import PluginSettings
+
+        # Folder sizes are computed in the background, keep the documents stable
+        Setting().set(PluginSettings.FOLDER_SIZE_TTL, 0)
         users = (
             {
                 "email": "root@dev.null",
@@ -395,6 +406,329 @@ class FolderOperationsTestCase(base.TestCase):
             )
             # TODO should probably check the content too...
 
+    def test_folder_download_read_ahead(self):
+        from girder.plugins.virtual_resources.constants import PluginSettings
+        from girder.plugins.virtual_resources.rest import VirtualObject
+
+        root_path = pathlib.Path(self.public_folder["fsPath"])
+        nested_dir = root_path / "many_files"
+        (nested_dir / "sub").mkdir(parents=True)
+        contents = {}
+        for i in range(20):
+            name = "sub/file%02d.bin" % i if i % 3 else "file%02d.bin" % i
+            contents[name] = bytes([i]) * (i * 150000)
+            (nested_dir / name).write_bytes(contents[name])
+
+        # A budget smaller than a single block still makes progress
+        Setting().set(PluginSettings.DOWNLOAD_WORKERS, 3)
+        Setting().set(PluginSettings.DOWNLOAD_READ_AHEAD_BYTES, 1)
+        resp = self.request(
+            path="/folder/{}/download".format(
+                VirtualObject.generate_id(nested_dir, self.public_folder["_id"])
+            ),
+            method="GET",
+            user=self.users["admin"],
+            isJson=False,
+        )
+        self.assertStatusOk(resp)
+        with zipfile.ZipFile(io.BytesIO(self.getBody(resp, text=False)), "r") as fp:
+            self.assertEqual(sorted(fp.namelist()), sorted(contents))
+            for name, data in contents.items():
+                self.assertEqual(fp.read(name), data)
+
+        Setting().unset(PluginSettings.DOWNLOAD_WORKERS)
+        Setting().unset(PluginSettings.DOWNLOAD_READ_AHEAD_BYTES)
+        shutil.rmtree(nested_dir.as_posix())
+
+    def test_folder_download_compression(self):
+        from girder.plugins.virtual_resources.rest import VirtualObject
+
+        root_path = pathlib.Path(self.public_folder["fsPath"])
+        nested_dir = root_path / "compressible"
+        nested_dir.mkdir()
+        contents = {
+            "table.csv": b"id,value\n" + b"1,2.5\n" * 400000,
+            "archive.gz": b"already compressed" * 100,
+            "noise.bin": os.urandom(200000),
+            "empty.txt": b"",
+        }
+        for name, data in contents.items():
+            (nested_dir / name).write_bytes(data)
+        folder_id = VirtualObject.generate_id(nested_dir, self.public_folder["_id"])
+
+        def download(**params):
+            resp = self.request(
+                path="/folder/{}/download".format(folder_id),
+                method="GET",
+                user=self.users["admin"],
+                isJson=False,
+                params=params,
+            )
+            self.assertStatusOk(resp)
+            fp = zipfile.ZipFile(io.BytesIO(self.getBody(resp, text=False)), "r")
+            self.assertIsNone(fp.testzip())
+            for name, data in contents.items():
+                self.assertEqual(fp.read(name), data)
+            return {info.filename: info.compress_type for info in fp.infolist()}
+
+        self.assertEqual(
+            download(),
+            {
+                "archive.gz": zipfile.ZIP_STORED,
+                "empty.txt": zipfile.ZIP_STORED,
+                "noise.bin": zipfile.ZIP_STORED,
+                "table.csv": zipfile.ZIP_DEFLATED,
+            },
+        )
+        self.assertEqual(
+            set(download(compression="store").values()), {zipfile.ZIP_STORED}
+        )
+        self.assertEqual(
+            set(download(compression="deflate", compressionLevel=1).values()),
+            {zipfile.ZIP_DEFLATED},
+        )
+
+        for params in ({"compression": "lzma"}, {"compressionLevel": 11}):
+            resp = self.request(
+                path="/folder/{}/download".format(folder_id),
+                method="GET",
+                user=self.users["admin"],
+                params=params,
+            )
+            self.assertStatus(resp, 400)
+
+        shutil.rmtree(nested_dir.as_posix())
+
+    def test_folder_download_resume(self):
+        from girder.plugins.virtual_resources.rest import VirtualObject
+
+        root_path = pathlib.Path(self.public_folder["fsPath"])
+        nested_dir = root_path / "resumable"
+        (nested_dir / "sub").mkdir(parents=True)
+        contents = {
+            "first.bin": os.urandom(300000),
+            "sub/second.txt": b"second\n" * 1000,
+            "sub/empty": b"",
+        }
+        for name, data in contents.items():
+            (nested_dir / name).write_bytes(data)
+        folder_id = VirtualObject.generate_id(nested_dir, self.public_folder["_id"])
+
+        def download(**headers):
+            return self.request(
+                path="/folder/{}/download".format(folder_id),
+                method="GET",
+                user=self.users["admin"],
+                isJson=False,
+                params={"compression": "store"},
+                additionalHeaders=list(headers.items()),
+            )
+
+        resp = download()
+        self.assertStatusOk(resp)
+        archive = self.getBody(resp, text=False)
+        self.assertEqual(int(resp.headers["Content-Length"]), len(archive))
+        self.assertEqual(resp.headers["Accept-Ranges"], "bytes")
+        etag = resp.headers["ETag"]
+        fp = zipfile.ZipFile(io.BytesIO(archive), "r")
+        self.assertIsNone(fp.testzip())
+        for name, data in contents.items():
+            self.assertEqual(fp.read(name), data)
+
+        # The same tree gives the same bytes, any slice can be fetched on its own
+        self.assertEqual(self.getBody(download(), text=False), archive)
+        for start, end in ((0, 99), (1000, 200000), (300050, len(archive) - 1)):
+            resp = download(Range="bytes=%d-%d" % (start, end))
+            self.assertStatus(resp, 206)
+            self.assertEqual(
+                resp.headers["Content-Range"],
+                "bytes %d-%d/%d" % (start, end, len(archive)),
+            )
+            self.assertEqual(self.getBody(resp, text=False), archive[start:end + 1])
+        resp = download(Range="bytes=-22")
+        self.assertStatus(resp, 206)
+        self.assertEqual(self.getBody(resp, text=False), archive[-22:])
+        resp = download(Range="bytes=%d-" % len(archive))
+        self.assertStatus(resp, 416)
+        self.assertEqual(resp.headers["Content-Range"], "bytes */%d" % len(archive))
+
+        # CRCs are kept from the full download, a resume only reads what it sends
+        from girder.plugins.virtual_resources.rest.checksums import checksums
+
+        for name, data in contents.items():
+            self.assertEqual(
+                checksums.crc32(nested_dir / name, os.stat((nested_dir / name).as_posix())),
+                zlib.crc32(data),
+            )
+
+        resp = download(Range="bytes=100-", **{"If-Range": etag})
+        self.assertStatus(resp, 206)
+        self.assertEqual(self.getBody(resp, text=False), archive[100:])
+        resp = download(**{"If-None-Match": etag})
+        self.assertStatus(resp, 304)
+
+        # Renaming changes the layout but not the newest mtime, so dates aren't
+        # validators of the archive
+        self.assertNotIn("Last-Modified", resp.headers)
+        date = "Sun, 01 Jan 2090 00:00:00 GMT"
+        resp = download(**{"If-Modified-Since": date})
+        self.assertStatusOk(resp)
+        resp = download(Range="bytes=100-", **{"If-Range": date})
+        self.assertStatusOk(resp)
+        self.assertEqual(self.getBody(resp, text=False), archive)
+
+        # A changed tree invalidates partial downloads
+        (nested_dir / "sub" / "second.txt").write_bytes(b"changed")
+        resp = download(Range="bytes=100-", **{"If-Range": etag})
+        self.assertStatusOk(resp)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        fp = zipfile.ZipFile(io.BytesIO(self.getBody(resp, text=False)), "r")
+        self.assertEqual(fp.read("sub/second.txt"), b"changed")
+
+        shutil.rmtree(nested_dir.as_posix())
+
+    def test_folder_download_tar(self):
+        from girder.plugins.virtual_resources.rest import VirtualObject
+        from girder.plugins.virtual_resources.rest.archive import zstandard
+
+        root_path = pathlib.Path(self.public_folder["fsPath"])
+        nested_dir = root_path / "tarred"
+        (nested_dir / "bin").mkdir(parents=True)
+        script = nested_dir / "bin" / "run.sh"
+        script.write_bytes(b"#!/bin/sh\necho run\n")
+        script.chmod(0o750)
+        os.utime(script.as_posix(), (1500000000, 1500000000))
+        (nested_dir / "data.csv").write_bytes(b"a,b\n1,2\n" * 1000)
+        (nested_dir / "run").symlink_to("bin/run.sh")
+        folder_id = VirtualObject.generate_id(nested_dir, self.public_folder["_id"])
+
+        def download(archive):
+            return self.request(
+                path="/folder/{}/download".format(folder_id),
+                method="GET",
+                user=self.users["admin"],
+                isJson=False,
+                params={"format": archive},
+            )
+
+        for archive, mode, content_type in (
+            ("tar", "r:", "application/x-tar"),
+            ("tar.gz", "r:gz", "application/gzip"),
+        ):
+            resp = download(archive)
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.headers["Content-Type"], content_type)
+            self.assertIn("tarred.%s" % archive, resp.headers["Content-Disposition"])
+            body = io.BytesIO(self.getBody(resp, text=False))
+            with tarfile.open(fileobj=body, mode=mode) as fp:
+                self.assertEqual(
+                    fp.getnames(), ["data.csv", "run", "bin", "bin/run.sh"]
+                )
+                member = fp.getmember("bin/run.sh")
+                self.assertEqual(member.mode, 0o750)
+                self.assertEqual(member.mtime, 1500000000)
+                self.assertEqual(fp.extractfile(member).read(), b"#!/bin/sh\necho run\n")
+                self.assertTrue(fp.getmember("bin").isdir())
+                self.assertTrue(fp.getmember("run").issym())
+                self.assertEqual(fp.getmember("run").linkname, "bin/run.sh")
+                self.assertEqual(
+                    fp.extractfile("data.csv").read(), b"a,b\n1,2\n" * 1000
+                )
+
+        resp = download("tar.zst")
+        self.assertStatus(resp, 200 if zstandard else 400)
+        resp = download("rar")
+        self.assertStatus(resp, 400)
+
+        shutil.rmtree(nested_dir.as_posix())
+
+    def test_folder_download_cache(self):
+        from girder.plugins.virtual_resources.constants import PluginSettings
+        from girder.plugins.virtual_resources.rest import VirtualObject
+
+        root_path = pathlib.Path(self.public_folder["fsPath"])
+        nested_dir = root_path / "course_data"
+        nested_dir.mkdir()
+        (nested_dir / "grades.csv").write_bytes(b"student,grade\n" * 1000)
+        folder_id = VirtualObject.generate_id(nested_dir, self.public_folder["_id"])
+        cache_root = tempfile.mkdtemp()
+        Setting().set(PluginSettings.ARCHIVE_CACHE_ROOT, cache_root)
+
+        def download(**headers):
+            return self.request(
+                path="/folder/{}/download".format(folder_id),
+                method="GET",
+                user=self.users["admin"],
+                isJson=False,
+                additionalHeaders=list(headers.items()),
+            )
+
+        def archive_stats():
+            resp = self.request(
+                path="/virtual_resource/cache", method="GET", user=self.users["admin"]
+            )
+            self.assertStatusOk(resp)
+            return resp.json["archives"]
+
+        resp = download()
+        self.assertStatusOk(resp)
+        archive = self.getBody(resp, text=False)
+        stats = archive_stats()
+        self.assertEqual((stats["entries"], stats["bytes"]), (1, len(archive)))
+
+        resp = download()
+        self.assertStatusOk(resp)
+        self.assertEqual(int(resp.headers["Content-Length"]), len(archive))
+        self.assertEqual(self.getBody(resp, text=False), archive)
+        self.assertEqual(archive_stats()["hits"], 1)
+        resp = download(**{"If-None-Match": resp.headers["ETag"]})
+        self.assertStatus(resp, 304)
+
+        # Another folder with a matching tree gets an archive of its own
+        twin_dir = root_path / "course_data_copy"
+        twin_dir.mkdir()
+        shutil.copy2(
+            (nested_dir / "grades.csv").as_posix(), (twin_dir / "grades.csv").as_posix()
+        )
+        resp = self.request(
+            path="/folder/{}/download".format(
+                VirtualObject.generate_id(twin_dir, self.public_folder["_id"])
+            ),
+            method="GET",
+            user=self.users["admin"],
+            isJson=False,
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(self.getBody(resp, text=False), archive)
+        self.assertEqual(archive_stats()["entries"], 2)
+        self.assertEqual(archive_stats()["hits"], 1)
+        shutil.rmtree(twin_dir.as_posix())
+
+        # Any change of the tree gives a new archive
+        (nested_dir / "grades.csv").write_bytes(b"student,grade\nsally,A\n")
+        resp = download()
+        self.assertStatusOk(resp)
+        fp = zipfile.ZipFile(io.BytesIO(self.getBody(resp, text=False)), "r")
+        self.assertEqual(fp.read("grades.csv"), b"student,grade\nsally,A\n")
+        self.assertEqual(archive_stats()["hits"], 1)
+
+        # Changes made through the API drop the archives right away
+        resp = self.request(
+            path="/item/{}".format(
+                VirtualObject.generate_id(
+                    nested_dir / "grades.csv", self.public_folder["_id"]
+                )
+            ),
+            method="DELETE",
+            user=self.users["admin"],
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(archive_stats()["entries"], 0)
+
+        Setting().unset(PluginSettings.ARCHIVE_CACHE_ROOT)
+        shutil.rmtree(cache_root)
+        shutil.rmtree(nested_dir.as_posix())
+
     def test_folder_copy(self):
         from girder.plugins.virtual_resources.rest import VirtualObject
 
@@ -575,6 +909,576 @@ class FolderOperationsTestCase(base.TestCase):
         self.assertEqual(len(resp.json), 0)
         shutil.rmtree(some_dir.as_posix())
 
+    def test_listing_cache(self):
+        root_path = pathlib.Path(self.public_folder["fsPath"])
+        (root_path / "cached_dir").mkdir()
+
+        resp = self.request(
+            path="/virtual_resource/cache", method="GET", user=self.users["sally"]
+        )
+        self.assertStatus(resp, 403)
+
+        def stats():
+            resp = self.request(
+                path="/virtual_resource/cache", method="GET", user=self.users["admin"]
+            )
+            self.assertStatusOk(resp)
+            return resp.json["listing"]
+
+        def listing():
+            resp = self.request(
+                path="/folder",
+                method="GET",
+                user=self.users["admin"],
+                params={
+                    "parentType": "folder",
+                    "parentId": str(self.public_folder["_id"]),
+                },
+            )
+            self.assertStatusOk(resp)
+            return sorted(folder["name"] for folder in resp.json)
+
+        self.assertEqual(listing(), ["cached_dir"])
+        before = stats()
+        self.assertEqual(listing(), ["cached_dir"])
+        after = stats()
+        self.assertEqual(after["hits"], before["hits"] + 1)
+        self.assertEqual(after["misses"], before["misses"])
+
+        # Our own mutations invalidate the cached listing
+        resp = self.request(
+            path="/folder",
+            method="POST",
+            user=self.users["admin"],
+            params={
+                "parentType": "folder",
+                "parentId": self.public_folder["_id"],
+                "name": "another_dir",
+            },
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(listing(), ["another_dir", "cached_dir"])
+        self.assertEqual(stats()["misses"], after["misses"] + 1)
+
+        shutil.rmtree((root_path / "cached_dir").as_posix())
+        shutil.rmtree((root_path / "another_dir").as_posix())
+
+    def test_listing_etag(self):
+        root_path = pathlib.Path(self.public_folder["fsPath"])
+        (root_path / "polled").mkdir()
+        (root_path / "polled" / "file.txt").write_bytes(b"data")
+        params = {"parentType": "folder", "parentId": str(self.public_folder["_id"])}
+
+        def get(path, user="admin", headers=None, **kwargs):
+            return self.request(
+                path=path,
+                method="GET",
+                user=self.users[user],
+                params=kwargs,
+                additionalHeaders=headers or [],
+                isJson=False,
+            )
+
+        resp = get("/folder", **params)
+        self.assertStatusOk(resp)
+        etag = resp.headers["ETag"]
+        self.assertTrue(etag.startswith('W/"'))
+
+        resp = get("/folder", headers=[("If-None-Match", etag)], **params)
+        self.assertStatus(resp, 304)
+        self.assertEqual(self.getBody(resp), "")
+
+        # The validator depends on the user and on the parameters
+        resp = get("/folder", user="sally", headers=[("If-None-Match", etag)], **params)
+        self.assertStatusOk(resp)
+        resp = get("/folder", headers=[("If-None-Match", etag)], limit=1, **params)
+        self.assertStatusOk(resp)
+
+        # Items and details
+        polled_id = json.loads(self.getBody(get("/folder", **params)))[0]["_id"]
+        for path, kwargs in (
+            ("/item", {"folderId": polled_id}),
+            ("/folder/%s/details" % polled_id, {}),
+        ):
+            resp = get(path, **kwargs)
+            self.assertStatusOk(resp)
+            resp = get(path, headers=[("If-None-Match", resp.headers["ETag"])], **kwargs)
+            self.assertStatus(resp, 304)
+
+        time.sleep(0.05)  # mtime granularity
+        resp = self.request(
+            path="/folder",
+            method="POST",
+            user=self.users["admin"],
+            params={
+                "parentType": "folder",
+                "parentId": self.public_folder["_id"],
+                "name": "another",
+            },
+        )
+        self.assertStatusOk(resp)
+        resp = get("/folder", headers=[("If-None-Match", etag)], **params)
+        self.assertStatusOk(resp)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        self.assertEqual(len(json.loads(self.getBody(resp))), 2)
+
+        shutil.rmtree((root_path / "polled").as_posix())
+        (root_path / "another").rmdir()
+
+    def test_mapping_index(self):
+        from girder.plugins.virtual_resources.constants import PluginSettings
+        from girder.plugins.virtual_resources.rest import VirtualObject
+
+        root_path = pathlib.Path(self.public_folder["fsPath"])
+        (root_path / "indexed_dir").mkdir()
+        for name in ("b.txt", "a.txt"):
+            with (root_path / "indexed_dir" / name).open(mode="wb") as fp:
+                fp.write(name.encode())
+
+        index_root = tempfile.mkdtemp()
+        resp = self.request(
+            path="/system/setting",
+            method="PUT",
+            user=self.users["admin"],
+            params={"key": PluginSettings.INDEX_ROOT, "value": index_root},
+        )
+        self.assertStatusOk(resp)
+
+        resp = self.request(
+            path="/virtual_folder/{_id}/index".format(**self.public_folder),
+            method="POST",
+            user=self.users["sally"],
+        )
+        self.assertStatus(resp, 403)
+        resp = self.request(
+            path="/virtual_folder/{_id}/index".format(**self.regular_folder),
+            method="POST",
+            user=self.users["admin"],
+        )
+        self.assertStatus(resp, 400)
+        resp = self.request(
+            path="/virtual_folder/{_id}/index".format(**self.public_folder),
+            method="POST",
+            user=self.users["admin"],
+        )
+        self.assertStatusOk(resp)
+        self.assertTrue(
+            (pathlib.Path(index_root) / "{_id}.sqlite".format(**self.public_folder))
+            .is_file()
+        )
+
+        resp = self.request(
+            path="/folder",
+            method="GET",
+            user=self.users["admin"],
+            params={"parentType": "folder", "parentId": str(self.public_folder["_id"])},
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual([_["name"] for _ in resp.json], ["indexed_dir"])
+        folder = resp.json[0]
+
+        resp = self.request(
+            path="/item",
+            method="GET",
+            user=self.users["admin"],
+            params={"folderId": folder["_id"], "sort": "name", "sortdir": -1},
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual([_["name"] for _ in resp.json], ["b.txt", "a.txt"])
+
+        # Changes on disk are picked up
+        (root_path / "indexed_dir" / "b.txt").unlink()
+        resp = self.request(
+            path="/folder/{_id}/details".format(**folder),
+            method="GET",
+            user=self.users["admin"],
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json["nFolders"], 0)
+        self.assertEqual(resp.json["nItems"], 1)
+
+        # Files written in place keep their directory's mtime
+        with (root_path / "indexed_dir" / "a.txt").open(mode="ab") as fp:
+            fp.write(b"appended")
+        resp = self.request(
+            path="/item",
+            method="GET",
+            user=self.users["admin"],
+            params={"folderId": folder["_id"]},
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual([_["size"] for _ in resp.json], [len(b"a.txtappended")])
+
+        # Subtrees only differing by case are told apart
+        for name in ("Data", "data"):
+            (root_path / "indexed_dir" / name / "sub").mkdir(parents=True)
+            with (root_path / "indexed_dir" / name / "sub" / "report").open("wb") as fp:
+                fp.write(b"data")
+            resp = self.request(
+                path="/item",
+                method="GET",
+                user=self.users["admin"],
+                params={
+                    "folderId": VirtualObject.generate_id(
+                        root_path / "indexed_dir" / name / "sub",
+                        self.public_folder["_id"],
+                    )
+                },
+            )
+            self.assertStatusOk(resp)
+        resp = self.request(
+            path="/item",
+            method="GET",
+            user=self.users["admin"],
+            params={
+                "folderId": VirtualObject.generate_id(
+                    root_path / "indexed_dir" / "Data", self.public_folder["_id"]
+                ),
+                "text": "report",
+                "recursive": True,
+            },
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json), 1)
+        self.assertEqual(
+            resp.json[0]["folderId"],
+            VirtualObject.generate_id(
+                root_path / "indexed_dir" / "Data" / "sub", self.public_folder["_id"]
+            ),
+        )
+
+        # Renamed subtrees and files added deep down are found
+        resp = self.request(
+            path="/folder/{}".format(
+                VirtualObject.generate_id(
+                    root_path / "indexed_dir" / "Data", self.public_folder["_id"]
+                )
+            ),
+            method="PUT",
+            user=self.users["admin"],
+            params={"name": "renamed"},
+        )
+        self.assertStatusOk(resp)
+        with (root_path / "indexed_dir" / "renamed" / "sub" / "report2").open("wb") as fp:
+            fp.write(b"data")
+        resp = self.request(
+            path="/item",
+            method="GET",
+            user=self.users["admin"],
+            params={"folderId": folder["_id"], "text": "report", "recursive": True},
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(
+            sorted(_["name"] for _ in resp.json), ["report", "report", "report2"]
+        )
+
+        # The plugin's own changes are applied to the index in place
+        resp = self.request(
+            path="/item",
+            method="POST",
+            user=self.users["admin"],
+            params={"folderId": folder["_id"], "name": "c.txt"},
+        )
+        self.assertStatusOk(resp)
+        db = sqlite3.connect(
+            os.path.join(index_root, "{_id}.sqlite".format(**self.public_folder))
+        )
+        self.assertEqual(
+            db.execute("SELECT mtime_ns FROM dirs WHERE path = 'indexed_dir'").fetchone(),
+            (os.stat((root_path / "indexed_dir").as_posix()).st_mtime_ns,),
+        )
+        self.assertEqual(
+            db.execute(
+                "SELECT kind, size FROM entries "
+                "WHERE parent = 'indexed_dir' AND name = 'c.txt'"
+            ).fetchone(),
+            ("item", 0),
+        )
+        db.close()
+
+        resp = self.request(
+            path="/virtual_folder/{_id}/index".format(**self.public_folder),
+            method="DELETE",
+            user=self.users["admin"],
+        )
+        self.assertStatusOk(resp)
+        self.assertFalse(
+            (pathlib.Path(index_root) / "{_id}.sqlite".format(**self.public_folder))
+            .exists()
+        )
+
+        Setting().unset(PluginSettings.INDEX_ROOT)
+        shutil.rmtree(index_root)
+        shutil.rmtree((root_path / "indexed_dir").as_posix())
+
+    def test_folder_children(self):
+        from girder.plugins.virtual_resources.rest import VirtualObject
+
+        root_path = pathlib.Path(self.private_folder["fsPath"])
+        (root_path / "dir_b").mkdir()
+        (root_path / "dir_a").mkdir()
+        for name in ("file1", "file2", "file3"):
+            with (root_path / name).open(mode="wb") as fp:
+                fp.write(b"data")
+
+        resp = self.request(
+            path="/virtual_folder/{_id}/children".format(**self.regular_folder),
+            method="GET",
+            user=self.users["admin"],
+        )
+        self.assertStatus(resp, 400)
+
+        resp = self.request(
+            path="/virtual_folder/{_id}/children".format(**self.private_folder),
+            method="GET",
+        )
+        self.assertStatus(resp, 401)
+
+        resp = self.request(
+            path="/virtual_folder/{_id}/children".format(**self.private_folder),
+            method="GET",
+            user=self.users["joel"],
+            params={"limit": 2},
+        )
+        self.assertStatusOk(resp)
+        children = resp.json
+        self.assertEqual([_["name"] for _ in children["folders"]], ["dir_a", "dir_b"])
+        self.assertEqual([_["name"] for _ in children["items"]], ["file1", "file2"])
+        self.assertEqual(children["nFolders"], 2)
+        self.assertEqual(children["nItems"], 3)
+        self.assertEqual(
+            children["folders"][0]["_id"],
+            VirtualObject.generate_id(root_path / "dir_a", self.private_folder["_id"]),
+        )
+
+        resp = self.request(
+            path="/virtual_folder/{_id}/children".format(**self.private_folder),
+            method="GET",
+            user=self.users["joel"],
+            params={
+                "limit": 2,
+                "folderCursor": children["folderCursor"],
+                "itemCursor": children["itemCursor"],
+            },
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json["folders"], [])
+        self.assertEqual([_["name"] for _ in resp.json["items"]], ["file3"])
+        self.assertIsNone(resp.json["itemCursor"])
+
+        for name in ("file1", "file2", "file3"):
+            (root_path / name).unlink()
+        (root_path / "dir_a").rmdir()
+        (root_path / "dir_b").rmdir()
+
+    def test_listing_filter(self):
+        root_path = pathlib.Path(self.private_folder["fsPath"])
+        for name in ("one", "two", "three"):
+            (root_path / name).mkdir()
+
+        for login in ("admin", "sally", "joel"):
+            resp = self.request(
+                path="/folder",
+                method="GET",
+                user=self.users[login],
+                params={
+                    "parentType": "folder",
+                    "parentId": str(self.private_folder["_id"]),
+                },
+            )
+            self.assertStatusOk(resp)
+            self.assertEqual(len(resp.json), 3)
+            for folder in resp.json:
+                single = self.request(
+                    path="/folder/{_id}".format(**folder),
+                    method="GET",
+                    user=self.users[login],
+                )
+                self.assertStatusOk(single)
+                self.assertEqual(folder, single.json)
+
+        for name in ("one", "two", "three"):
+            (root_path / name).rmdir()
+
+    def test_compact_ids(self):
+        from girder.plugins.virtual_resources.constants import PluginSettings
+        from girder.plugins.virtual_resources.rest import VirtualObject
+
+        root_path = pathlib.Path(self.public_folder["fsPath"])
+        nested = root_path / ("very_long_directory_name" * 4) / "level1"
+        nested.mkdir(parents=True)
+        legacy_id = VirtualObject.generate_id(nested, self.public_folder["_id"])
+
+        Setting().set(PluginSettings.COMPACT_IDS, True)
+        resp = self.request(
+            path="/folder",
+            method="GET",
+            user=self.users["admin"],
+            params={
+                "parentType": "folder",
+                "parentId": str(self.public_folder["_id"]),
+            },
+        )
+        self.assertStatusOk(resp)
+        top = resp.json[0]
+        self.assertTrue(top["_id"].startswith("wtlocal:~"))
+        self.assertEqual(len(top["_id"]), 31)
+
+        resp = self.request(
+            path="/folder",
+            method="GET",
+            user=self.users["admin"],
+            params={"parentType": "folder", "parentId": top["_id"]},
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json), 1)
+        compact = resp.json[0]
+        self.assertEqual(compact["name"], "level1")
+        self.assertEqual(compact["parentId"], top["_id"])
+        self.assertEqual(len(compact["_id"]), len(top["_id"]))
+
+        # Old ids keep working and point at the same folder
+        for folder_id in (legacy_id, compact["_id"]):
+            resp = self.request(
+                path="/folder/{}".format(folder_id),
+                method="GET",
+                user=self.users["admin"],
+            )
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.json["name"], "level1")
+
+        resp = self.request(
+            path="/folder/wtlocal:~AAAAAAAAAAAAAAAAAAAAAA",
+            method="GET",
+            user=self.users["admin"],
+        )
+        self.assertStatus(resp, 400)
+
+        Setting().unset(PluginSettings.COMPACT_IDS)
+        shutil.rmtree(nested.parent.as_posix())
+
+    def test_root_access_cache(self):
+        root_path = pathlib.Path(self.private_folder["fsPath"])
+        (root_path / "shared").mkdir()
+        params = {"parentType": "folder", "parentId": str(self.private_folder["_id"])}
+
+        resp = self.request(
+            path="/folder", method="GET", user=self.users["joel"], params=params
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json), 1)
+
+        # Revoking access takes effect immediately
+        access = Folder().getFullAccessList(self.private_folder)
+        access["users"] = [
+            entry for entry in access["users"] if entry["id"] != self.users["joel"]["_id"]
+        ]
+        resp = self.request(
+            path="/folder/{_id}/access".format(**self.private_folder),
+            method="PUT",
+            user=self.users["admin"],
+            params={"access": json.dumps(access, default=str), "public": False},
+        )
+        self.assertStatusOk(resp)
+
+        resp = self.request(
+            path="/folder", method="GET", user=self.users["joel"], params=params
+        )
+        self.assertStatus(resp, 403)
+
+        resp = self.request(
+            path="/folder", method="GET", user=self.users["sally"], params=params
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json), 1)
+        (root_path / "shared").rmdir()
+
+    def _wait_for_size(self, folder_id, expected):
+        for _ in range(50):
+            resp = self.request(
+                path="/folder/{}/details".format(folder_id),
+                method="GET",
+                user=self.users["admin"],
+            )
+            self.assertStatusOk(resp)
+            if resp.json.get("size") == expected:
+                return resp.json
+            time.sleep(0.1)
+        self.fail("Folder size was not computed")
+
+    def test_folder_sizes(self):
+        from girder.plugins.virtual_resources.constants import PluginSettings
+        from girder.plugins.virtual_resources.rest import VirtualObject
+
+        Setting().set(PluginSettings.FOLDER_SIZE_TTL, 300)
+        root_path = pathlib.Path(self.public_folder["fsPath"])
+        sized = root_path / "sized"
+        (sized / "sub").mkdir(parents=True)
+        (root_path / "small").mkdir()
+        (sized / "a.txt").write_bytes(b"abc")
+        (sized / "sub" / "b.txt").write_bytes(b"12345")
+        folder_id = VirtualObject.generate_id(sized, self.public_folder["_id"])
+
+        details = self._wait_for_size(folder_id, 8)
+        self.assertEqual(details["nFilesRecursive"], 2)
+        self._wait_for_size(
+            VirtualObject.generate_id(root_path / "small", self.public_folder["_id"]), 0
+        )
+
+        resp = self.request(
+            path="/folder",
+            method="GET",
+            user=self.users["admin"],
+            params={
+                "parentType": "folder",
+                "parentId": str(self.public_folder["_id"]),
+                "sort": "size",
+                "sortdir": -1,
+            },
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual([_["name"] for _ in resp.json], ["sized", "small"])
+        self.assertEqual(resp.json[0]["size"], 8)
+
+        # Walks that find the same totals keep cached listings valid
+        from girder.plugins.virtual_resources.rest.sizes import folder_sizes
+
+        params = {"parentType": "folder", "parentId": str(self.public_folder["_id"])}
+        resp = self.request(
+            path="/folder", method="GET", user=self.users["admin"], params=params
+        )
+        self.assertStatusOk(resp)
+        etag = resp.headers["ETag"]
+        folder_sizes.schedule(sized.as_posix())
+        for _ in range(50):
+            if folder_sizes.stats()["pending"] == 0:
+                break
+            time.sleep(0.1)
+        resp = self.request(
+            path="/folder",
+            method="GET",
+            user=self.users["admin"],
+            params=params,
+            additionalHeaders=[("If-None-Match", etag)],
+            isJson=False,
+        )
+        self.assertStatus(resp, 304)
+
+        # Removing through the API refreshes the parents
+        item_id = VirtualObject.generate_id(
+            sized / "sub" / "b.txt", self.public_folder["_id"]
+        )
+        resp = self.request(
+            path="/item/{}".format(item_id), method="DELETE", user=self.users["admin"]
+        )
+        self.assertStatusOk(resp)
+        details = self._wait_for_size(folder_id, 3)
+        self.assertEqual(details["nFilesRecursive"], 1)
+
+        shutil.rmtree(sized.as_posix())
+        (root_path / "small").rmdir()
+        Setting().unset(PluginSettings.FOLDER_SIZE_TTL)
+
     def tearDown(self):
         Folder().remove(self.public_folder)
         Folder().remove(self.private_folder)
@@ -410,6 +410,123 @@ class ItemOperationsTestCase(base.TestCase):
         file1.unlink()
         (root_path / "existing.txt (1)").unlink()
 
+    def test_item_listing_pagination(self):
+        root_path = pathlib.Path(self.public_folder["fsPath"])
+        names = ["b_file", "a_file", "D_file", "c_file"]
+        for i, name in enumerate(names):
+            with (root_path / name).open(mode="wb") as fp:
+                fp.write(b"x" * (i + 1))
+
+        def listing(**params):
+            params.update(
+                {"parentType": "folder", "parentId": str(self.public_folder["_id"])}
+            )
+            resp = self.request(
+                path="/item", method="GET", user=self.users["admin"], params=params
+            )
+            self.assertStatusOk(resp)
+            return [item["name"] for item in resp.json]
+
+        self.assertEqual(listing(), ["a_file", "b_file", "c_file", "D_file"])
+        self.assertEqual(listing(limit=2, offset=1), ["b_file", "c_file"])
+        self.assertEqual(listing(sort="name", limit=1), ["D_file"])
+        self.assertEqual(
+            listing(sort="size", sortdir=-1, limit=2, offset=1), ["D_file", "a_file"]
+        )
+        self.assertEqual(listing(limit=0, offset=3), ["D_file"])
+
+        # Cursor based pagination
+        params = {
+            "parentType": "folder",
+            "parentId": str(self.public_folder["_id"]),
+            "limit": 3,
+        }
+        resp = self.request(
+            path="/item", method="GET", user=self.users["admin"], params=params
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json), 3)
+        params["cursor"] = resp.headers["Girder-Next-Cursor"]
+        resp = self.request(
+            path="/item", method="GET", user=self.users["admin"], params=params
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual([item["name"] for item in resp.json], ["D_file"])
+        self.assertNotIn("Girder-Next-Cursor", resp.headers)
+
+        params["sortdir"] = -1
+        resp = self.request(
+            path="/item", method="GET", user=self.users["admin"], params=params
+        )
+        self.assertStatus(resp, 400)
+
+        for name in names:
+            (root_path / name).unlink()
+
+    def test_item_search(self):
+        root_path = pathlib.Path(self.public_folder["fsPath"])
+        nested_dir = root_path / "level0" / "level1"
+        nested_dir.mkdir(parents=True)
+        for path in (
+            root_path / "Report.csv",
+            root_path / "level0" / "report_2.txt",
+            nested_dir / "old_REPORT",
+            nested_dir / "unrelated",
+        ):
+            with path.open(mode="wb") as fp:
+                fp.write(b"data")
+
+        def search(**params):
+            params.update(
+                {"parentType": "folder", "parentId": str(self.public_folder["_id"])}
+            )
+            resp = self.request(
+                path="/item", method="GET", user=self.users["admin"], params=params
+            )
+            self.assertStatusOk(resp)
+            return [item["name"] for item in resp.json]
+
+        self.assertEqual(search(text="REPORT"), ["Report.csv"])
+        self.assertEqual(
+            search(text="report", recursive=True),
+            ["old_REPORT", "Report.csv", "report_2.txt"],
+        )
+        self.assertEqual(search(text="nope", recursive=True), [])
+
+        # Full pages of a recursive search don't advertise a cursor
+        resp = self.request(
+            path="/item",
+            method="GET",
+            user=self.users["admin"],
+            params={
+                "parentType": "folder",
+                "parentId": str(self.public_folder["_id"]),
+                "text": "report",
+                "recursive": True,
+                "limit": 2,
+            },
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json), 2)
+        self.assertNotIn("Girder-Next-Cursor", resp.headers)
+
+        resp = self.request(
+            path="/folder",
+            method="GET",
+            user=self.users["admin"],
+            params={
+                "parentType": "folder",
+                "parentId": str(self.public_folder["_id"]),
+                "text": "level1",
+                "recursive": True,
+            },
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual([folder["name"] for folder in resp.json], ["level1"])
+
+        (root_path / "Report.csv").unlink()
+        shutil.rmtree((root_path / "level0").as_posix())
+
     def tearDown(self):
         for folder in (self.public_folder, self.private_folder, self.regular_folder):
             Folder().remove(folder)
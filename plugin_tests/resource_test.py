@@ -1,15 +1,20 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
 import json
 import pathlib
 import shutil
+import tarfile
 import tempfile
+import zipfile
 
 from tests import base
 
 from girder.models.collection import Collection
+from girder.models.file import File
 from girder.models.folder import Folder
+from girder.models.upload import Upload
 from girder.models.user import User
 
 
@@ -419,6 +424,128 @@ class ResourceOperationsTestCase(base.TestCase):
         file1.unlink()
         nested_dir.rmdir()
 
+    def test_download(self):
+        from girder.plugins.virtual_resources.rest import VirtualObject
+
+        root_path = pathlib.Path(self.public_folder["fsPath"])
+        nested_dir = root_path / "selected"
+        nested_dir.mkdir()
+        (nested_dir / "inner.txt").write_bytes(b"inner")
+        file1 = root_path / "loose.txt"
+        file1.write_bytes(b"loose")
+        girder_data = b"stored in girder"
+        Upload().uploadFromFile(
+            io.BytesIO(girder_data),
+            len(girder_data),
+            "girder.txt",
+            parentType="folder",
+            parent=self.regular_folder,
+            user=self.users["admin"],
+        )
+
+        resources = {
+            "folder": [
+                VirtualObject.generate_id(nested_dir, self.public_folder["_id"]),
+                str(self.regular_folder["_id"]),
+            ],
+            "item": [VirtualObject.generate_id(file1, self.public_folder["_id"])],
+        }
+        expected = {
+            "selected/inner.txt": b"inner",
+            "public_no_map/girder.txt": girder_data,
+            "loose.txt": b"loose",
+        }
+
+        # Selections without virtual resources are left to Girder
+        resp = self.request(
+            path="/resource/download",
+            method="GET",
+            user=self.users["admin"],
+            isJson=False,
+            params={"resources": json.dumps({"folder": [str(self.regular_folder["_id"])]})},
+        )
+        self.assertStatusOk(resp)
+        fp = zipfile.ZipFile(io.BytesIO(self.getBody(resp, text=False)), "r")
+        self.assertEqual(fp.namelist(), ["public_no_map/girder.txt"])
+
+        for method in ("GET", "POST"):
+            resp = self.request(
+                path="/resource/download",
+                method=method,
+                user=self.users["admin"],
+                isJson=False,
+                params={"resources": json.dumps(resources)},
+            )
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.headers["Content-Type"], "application/zip")
+            fp = zipfile.ZipFile(io.BytesIO(self.getBody(resp, text=False)), "r")
+            self.assertIsNone(fp.testzip())
+            self.assertEqual(sorted(fp.namelist()), sorted(expected))
+            for name, data in expected.items():
+                self.assertEqual(fp.read(name), data)
+
+        # A link's content doesn't match its size, the members after it are intact
+        File().createLinkFile(
+            "link.url",
+            self.regular_folder,
+            "folder",
+            "http://example.com/data",
+            self.users["admin"],
+        )
+        expected["public_no_map/link.url"] = b""
+        resp = self.request(
+            path="/resource/download",
+            method="GET",
+            user=self.users["admin"],
+            isJson=False,
+            params={"resources": json.dumps(resources), "format": "tar.gz"},
+        )
+        self.assertStatusOk(resp)
+        body = io.BytesIO(self.getBody(resp, text=False))
+        with tarfile.open(fileobj=body, mode="r:gz") as fp:
+            self.assertIn("selected", fp.getnames())
+            for name, data in expected.items():
+                self.assertEqual(fp.extractfile(name).read(), data)
+
+        # A selected mapping root is named after its folder, as in Girder
+        resp = self.request(
+            path="/resource/download",
+            method="GET",
+            user=self.users["admin"],
+            isJson=False,
+            params={"resources": json.dumps({"folder": [str(self.public_folder["_id"])]})},
+        )
+        self.assertStatusOk(resp)
+        fp = zipfile.ZipFile(io.BytesIO(self.getBody(resp, text=False)), "r")
+        self.assertEqual(
+            sorted(fp.namelist()), ["public/loose.txt", "public/selected/inner.txt"]
+        )
+
+        # The selection is checked before anything is streamed
+        private_dir = pathlib.Path(self.private_folder["fsPath"]) / "secret"
+        private_dir.mkdir()
+        resources["folder"].append(
+            VirtualObject.generate_id(private_dir, self.private_folder["_id"])
+        )
+        resp = self.request(
+            path="/resource/download",
+            method="GET",
+            user=self.users["admin"],
+            isJson=False,
+            params={"resources": json.dumps(resources)},
+        )
+        self.assertStatusOk(resp)
+        resp = self.request(
+            path="/resource/download",
+            method="GET",
+            params={"resources": json.dumps(resources)},
+        )
+        self.assertStatus(resp, 401)
+
+        shutil.rmtree(nested_dir.as_posix())
+        private_dir.rmdir()
+        file1.unlink()
+
     def tearDown(self):
         for folder in (self.public_folder, self.private_folder, self.regular_folder):
             Folder().remove(folder)
@@ -1,19 +1,205 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
 import pathlib
 
 from girder import events
+from girder.api.v1.file import File as FileResource
 from girder.api.v1.folder import Folder as FolderResource
+from girder.api.v1.item import Item as ItemResource
+from girder.api.v1.resource import Resource as ResourceResource
 from girder.api.rest import boundHandler
 from girder.constants import AccessType
+from girder.exceptions import ValidationException
 from girder.models.folder import Folder
+from girder.models.setting import Setting
+from girder.utility import setting_utilities
 
+from .constants import FS_CHANGED_EVENT, PluginSettings
+from .rest.archive import archive_options
+from .rest.archive_cache import archive_cache
+from .rest.checksums import checksums
+from .rest.ids import compact_ids
+from .rest.index import index_registry
+from .rest.listing import listing_cache
+from .rest.mappings import mapping_registry
+from .rest.offload import SENDFILE_HEADERS, sendfile_offload
+from .rest.roots import root_cache
+from .rest.sizes import folder_sizes
 from .rest.virtual_item import VirtualItem
 from .rest.virtual_file import VirtualFile
 from .rest.virtual_folder import VirtualFolder
 from .rest.virtual_resource import VirtualResource
 
 
+@setting_utilities.validator(
+    {
+        PluginSettings.LISTING_CACHE_ENTRIES,
+        PluginSettings.LISTING_CACHE_BYTES,
+        PluginSettings.FOLDER_SIZE_TTL,
+        PluginSettings.ARCHIVE_CACHE_BYTES,
+    }
+)
+def validate_non_negative_int(doc):
+    try:
+        doc["value"] = int(doc["value"])
+        if doc["value"] < 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        raise ValidationException(
+            "%s must be a non-negative integer." % doc["key"], "value"
+        )
+
+
+@setting_utilities.default(PluginSettings.LISTING_CACHE_ENTRIES)
+def default_listing_cache_entries():
+    return 256
+
+
+@setting_utilities.default(PluginSettings.LISTING_CACHE_BYTES)
+def default_listing_cache_bytes():
+    return 64 * 1024 ** 2
+
+
+@setting_utilities.default(PluginSettings.FOLDER_SIZE_TTL)
+def default_folder_size_ttl():
+    return 300
+
+
+@setting_utilities.default(PluginSettings.ARCHIVE_CACHE_BYTES)
+def default_archive_cache_bytes():
+    return 10 * 1024 ** 3
+
+
+@setting_utilities.validator(
+    {
+        PluginSettings.DOWNLOAD_WORKERS,
+        PluginSettings.DOWNLOAD_READ_AHEAD_BYTES,
+        PluginSettings.CHECKSUM_WORKERS,
+    }
+)
+def validate_positive_int(doc):
+    try:
+        doc["value"] = int(doc["value"])
+        if doc["value"] < 1:
+            raise ValueError
+    except (TypeError, ValueError):
+        raise ValidationException("%s must be a positive integer." % doc["key"], "value")
+
+
+@setting_utilities.default(PluginSettings.DOWNLOAD_WORKERS)
+def default_download_workers():
+    return 4
+
+
+@setting_utilities.default(PluginSettings.DOWNLOAD_READ_AHEAD_BYTES)
+def default_download_read_ahead_bytes():
+    return 64 * 1024 ** 2
+
+
+@setting_utilities.default(PluginSettings.CHECKSUM_WORKERS)
+def default_checksum_workers():
+    return 2
+
+
+@setting_utilities.validator(PluginSettings.COMPACT_IDS)
+def validate_compact_ids(doc):
+    if not isinstance(doc["value"], bool):
+        raise ValidationException("Compact ids setting must be a boolean.", "value")
+
+
+@setting_utilities.default(PluginSettings.COMPACT_IDS)
+def default_compact_ids():
+    return False
+
+
+@setting_utilities.validator(PluginSettings.SENDFILE_HEADER)
+def validate_sendfile_header(doc):
+    if not doc["value"]:
+        doc["value"] = ""
+    elif doc["value"] not in SENDFILE_HEADERS:
+        raise ValidationException(
+            "Sendfile header must be one of: %s." % ", ".join(SENDFILE_HEADERS),
+            "value",
+        )
+
+
+@setting_utilities.default(PluginSettings.SENDFILE_HEADER)
+def default_sendfile_header():
+    return ""
+
+
+@setting_utilities.validator(PluginSettings.SENDFILE_PREFIX)
+def validate_sendfile_prefix(doc):
+    if not doc["value"]:
+        doc["value"] = ""
+    elif not doc["value"].startswith("/"):
+        raise ValidationException("Sendfile prefix must start with a slash.", "value")
+
+
+@setting_utilities.default(PluginSettings.SENDFILE_PREFIX)
+def default_sendfile_prefix():
+    return ""
+
+
+@setting_utilities.validator(PluginSettings.INDEX_ROOT)
+def validate_index_root(doc):
+    if not doc["value"]:
+        doc["value"] = ""
+    elif not os.path.isabs(doc["value"]):
+        raise ValidationException("Index root must be an absolute path.", "value")
+
+
+@setting_utilities.default(PluginSettings.INDEX_ROOT)
+def default_index_root():
+    return ""
+
+
+@setting_utilities.validator(PluginSettings.ARCHIVE_CACHE_ROOT)
+def validate_archive_cache_root(doc):
+    if not doc["value"]:
+        doc["value"] = ""
+    elif not os.path.isabs(doc["value"]):
+        raise ValidationException("Archive cache root must be an absolute path.", "value")
+
+
+@setting_utilities.default(PluginSettings.ARCHIVE_CACHE_ROOT)
+def default_archive_cache_root():
+    return ""
+
+
+def configure_caches(event=None):
+    if event is not None and not event.info.get("key", "").startswith(
+        "virtual_resources."
+    ):
+        return
+    listing_cache.configure(
+        max_entries=Setting().get(PluginSettings.LISTING_CACHE_ENTRIES),
+        max_bytes=Setting().get(PluginSettings.LISTING_CACHE_BYTES),
+    )
+    index_registry.configure(Setting().get(PluginSettings.INDEX_ROOT))
+    folder_sizes.configure(ttl=Setting().get(PluginSettings.FOLDER_SIZE_TTL))
+    compact_ids.configure(Setting().get(PluginSettings.COMPACT_IDS))
+    archive_options.configure(
+        workers=Setting().get(PluginSettings.DOWNLOAD_WORKERS),
+        read_ahead_bytes=Setting().get(PluginSettings.DOWNLOAD_READ_AHEAD_BYTES),
+    )
+    sendfile_offload.configure(
+        Setting().get(PluginSettings.SENDFILE_HEADER),
+        Setting().get(PluginSettings.SENDFILE_PREFIX),
+    )
+    archive_cache.configure(
+        root=Setting().get(PluginSettings.ARCHIVE_CACHE_ROOT),
+        max_bytes=Setting().get(PluginSettings.ARCHIVE_CACHE_BYTES),
+    )
+    checksums.configure(workers=Setting().get(PluginSettings.CHECKSUM_WORKERS))
+
+
+def forget_mapping_ids(event):
+    if event.info.get("fsPath"):
+        compact_ids.forget_root(event.info["_id"])
+
+
 @boundHandler
 def mapping_folder_update(self, event):
     params = event.info["params"]
@@ -55,6 +241,66 @@ def load(info):
             ).param("fsPath", "Local filesystem path it maps to.", required=False)
         )
 
+    FolderResource.downloadFolder.description.param(
+        "compression",
+        "Compression of virtual folder archives: auto (by file type), store or "
+        "deflate. Stored archives have a Content-Length and support Range "
+        "requests.",
+        required=False,
+        enum=["auto", "store", "deflate"],
+    ).param(
+        "compressionLevel",
+        "Compression level of virtual folder archives, 1-9.",
+        required=False,
+        dataType="integer",
+    ).param(
+        "format",
+        "Archive format of virtual folders. Tar archives keep modes, "
+        "modification times and symlinks.",
+        required=False,
+        enum=["zip", "tar", "tar.gz", "tar.zst"],
+    )
+    ResourceResource.download.description.param(
+        "compression",
+        "Compression of archives with virtual resources: auto (by file type), "
+        "store or deflate.",
+        required=False,
+        enum=["auto", "store", "deflate"],
+    ).param(
+        "compressionLevel",
+        "Compression level of archives with virtual resources, 1-9.",
+        required=False,
+        dataType="integer",
+    ).param(
+        "format",
+        "Archive format of selections with virtual resources.",
+        required=False,
+        enum=["zip", "tar", "tar.gz", "tar.zst"],
+    )
+
+    FileResource.getFile.description.param(
+        "checksums",
+        "Whether to include the sha256 and md5 checksums of virtual files. "
+        "Checksums that take longer than a couple of seconds to compute are "
+        "left out and computed in the background.",
+        required=False,
+        dataType="boolean",
+    )
+    ItemResource.find.description.param(
+        "checksums",
+        "Whether to include the checksums of virtual items that are known "
+        "already, the others are computed in the background.",
+        required=False,
+        dataType="boolean",
+    )
+    FileResource.initUpload.description.param(
+        "parallel",
+        "Whether chunks of an upload into a virtual folder may be sent "
+        "concurrently and in any order.",
+        required=False,
+        dataType="boolean",
+    )
+
     info["apiRoot"].virtual_item = VirtualItem()
     virtual_file = VirtualFile()
     info["apiRoot"].virtual_file = virtual_file
@@ -63,3 +309,21 @@ def load(info):
     events.bind(
         "rest.get.item/:id/download.before", info["name"], virtual_file.file_download
     )
+
+    # Only mapping folders have an fsPath, the registry reloads them by it
+    Folder().ensureIndex(("fsPath", {"sparse": True}))
+    mapping_registry.reload()
+    events.bind("model.folder.save.after", info["name"], mapping_registry.save_event)
+    events.bind("model.folder.remove", info["name"], mapping_registry.remove_event)
+    events.bind("model.folder.remove", "compact_ids", forget_mapping_ids)
+    # Covers access changes (PUT /folder/:id/access) and mapping_folder_update
+    events.bind("model.folder.save.after", "root_cache", root_cache.invalidate_event)
+    events.bind("model.folder.remove", "root_cache", root_cache.invalidate_event)
+
+    configure_caches()
+    events.bind("model.setting.save.after", info["name"], configure_caches)
+    events.bind("model.setting.remove", info["name"], configure_caches)
+    events.bind(FS_CHANGED_EVENT, "listing_cache", listing_cache.invalidate_event)
+    events.bind(FS_CHANGED_EVENT, "index_registry", index_registry.invalidate_event)
+    events.bind(FS_CHANGED_EVENT, "folder_sizes", folder_sizes.invalidate_event)
+    events.bind(FS_CHANGED_EVENT, "archive_cache", archive_cache.invalidate_event)
@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Triggered by the plugin whenever it creates, removes or renames something on disk.
+# ``event.info`` is a list of the affected ``pathlib.Path`` objects.
+FS_CHANGED_EVENT = "virtual_resources.fs_changed"
+
+
+class PluginSettings:
+    LISTING_CACHE_ENTRIES = "virtual_resources.listing_cache_entries"
+    LISTING_CACHE_BYTES = "virtual_resources.listing_cache_bytes"
+    INDEX_ROOT = "virtual_resources.index_root"
+    FOLDER_SIZE_TTL = "virtual_resources.folder_size_ttl"
+    COMPACT_IDS = "virtual_resources.compact_ids"
+    SENDFILE_HEADER = "virtual_resources.sendfile_header"
+    SENDFILE_PREFIX = "virtual_resources.sendfile_prefix"
+    DOWNLOAD_WORKERS = "virtual_resources.download_workers"
+    DOWNLOAD_READ_AHEAD_BYTES = "virtual_resources.download_read_ahead_bytes"
+    ARCHIVE_CACHE_ROOT = "virtual_resources.archive_cache_root"
+    ARCHIVE_CACHE_BYTES = "virtual_resources.archive_cache_bytes"
+    CHECKSUM_WORKERS = "virtual_resources.checksum_workers"
@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from girder.models.model_base import Model
+
+
+class VirtualId(Model):
+    """
+    Reverse lookup table of compact virtual object ids.
+
+    Documents are ``{"_id": <hash>, "rootId": <mapping id>, "path": <path
+    relative to the mapping root>}``.
+    """
+
+    def initialize(self):
+        self.name = "virtual_resources_id"
+        self.ensureIndices(["rootId"])
+
+    def validate(self, doc):
+        return doc
@@ -5,12 +5,32 @@ import copy
 import datetime
 import os
 import pathlib
+import pymongo
 
+from girder import events
 from girder.api.rest import Resource
 from girder.constants import AccessType
 from girder.exceptions import ValidationException
-from girder.models.folder import Folder
 from girder.models.upload import Upload
+from girder.utility import toBool
+
+from ..constants import FS_CHANGED_EVENT
+from .conditional import check_not_modified, listing_etag
+from .ids import COMPACT_PREFIX, compact_ids
+from .index import index_registry
+from .listing import (
+    SORT_KEYS,
+    cursor_key,
+    decode_cursor,
+    encode_cursor,
+    listing_cache,
+    lookup_entry,
+    search_tree,
+    select_page,
+)
+from .mappings import mapping_registry
+from .roots import root_cache
+from .sizes import folder_sizes
 
 
 def bail_if_exists(path):
@@ -31,6 +51,61 @@ def ensure_unique_path(dirname, name):
     return dirname / new_name
 
 
+def notify_changed(*paths):
+    """Let the plugin's caches know that ``paths`` were created, changed or removed."""
+    events.trigger(FS_CHANGED_EVENT, info=list(paths))
+
+
+def filter_children(model, docs, user):
+    """
+    Filter many virtual documents of a single mapping for ``user``.
+
+    Virtual objects carry the access list and public flag of their mapping
+    root, so access only needs to be evaluated once: the first document goes
+    through ``model.filter`` and the result is applied to the rest.
+    """
+    if not docs:
+        return []
+    template = model.filter(docs[0], user=user)
+    keys = [key for key in template if key in docs[0]]
+    stamped = {key: value for key, value in template.items() if key not in docs[0]}
+    filtered = [template]
+    for doc in docs[1:]:
+        child = {key: doc[key] for key in keys if key in doc}
+        child.update(copy.deepcopy(stamped))
+        filtered.append(child)
+    return filtered
+
+
+def load_root(root_id, level, user):
+    """
+    Load the root folder of a mapping, checking the user's access to it.
+
+    :returns: the folder, or ``None`` if it isn't a mapping anymore and the
+        request is Girder's to handle.
+    """
+    root = root_cache.load(root_id, level, user)
+    if not root.get("fsPath"):
+        # Unmapped by another process since the registry was loaded
+        mapping_registry.remove(root)
+        return None
+    return root
+
+
+def _listing_key(sort_key, make_doc, by_total_size=False):
+    if by_total_size:
+        def key(entry):
+            return folder_sizes.size_of(entry), entry.name
+
+    elif sort_key in SORT_KEYS:
+        key = cursor_key(sort_key)
+    else:
+        def key(entry):
+            return make_doc(entry)[sort_key]
+
+    return key
+
+
 def validate_event(level=AccessType.READ):
     def validation(func):
         def wrapper(self, event):
@@ -64,8 +139,9 @@ def validate_event(level=AccessType.READ):
                 path = pathlib.Path(path)
                 if path.is_absolute():
                     user = self.getCurrentUser()
-                    root = Folder().load(root_id, level=level, user=user, exc=True)
-                    func(self, event, path, root, user=user)
+                    root = load_root(root_id, level, user)
+                    if root is not None:
+                        func(self, event, path, root, user=user)
 
         return wrapper
 
@@ -80,22 +156,181 @@ class VirtualObject(Resource):
     def generate_id(path, root_id):
         if isinstance(path, pathlib.Path):
             path = path.as_posix()
+        if compact_ids.enabled:
+            fs_path = mapping_registry.get(root_id)
+            if fs_path:
+                root_path = pathlib.Path(fs_path).as_posix()
+                if path == root_path:
+                    return compact_ids.generate(root_id, "")
+                if path.startswith(root_path.rstrip("/") + "/"):
+                    return compact_ids.generate(
+                        root_id, path[len(root_path.rstrip("/")) + 1:]
+                    )
         path += "|" + str(root_id)
         return "wtlocal:" + base64.b64encode(path.encode()).decode()
 
     @staticmethod
     def path_from_id(object_id):
-        if str(object_id).startswith("wtlocal:"):
+        if str(object_id).startswith(COMPACT_PREFIX):
+            resolved = compact_ids.resolve(object_id)
+            if resolved is None:
+                raise ValidationException("Invalid ObjectId: %s" % object_id, "id")
+            root_id, rel = resolved
+            fs_path = mapping_registry.get(root_id)
+            path = pathlib.Path(fs_path) / rel if fs_path else None
+            return path, root_id
+        elif str(object_id).startswith("wtlocal:"):
             decoded = base64.b64decode(object_id[8:]).decode()
             path, root_id = decoded.split("|")
         else:
-            root_folder = Folder().load(object_id, force=True) or {}
-            path = root_folder.get("fsPath")  # only exists on virtual folders
-            root_id = str(root_folder.get("_id"))
+            # Only mapping folders have an fsPath, anything else is left to Girder
+            path = mapping_registry.get(object_id)
+            root_id = str(object_id)
         if path:
             path = pathlib.Path(path)
         return path, root_id
 
+    @staticmethod
+    def scan_children(path, root):
+        """
+        Scan ``path`` once, for callers that need both folders and items.
+
+        :returns: ``(folders, items)`` or ``None`` if the mapping has an index,
+            which is then queried directly.
+        """
+        if index_registry.get(root) is not None:
+            return None
+        return listing_cache.scan(path)
+
+    @staticmethod
+    def list_children(path, root, params, make_doc, folders=True, scan=None):
+        """
+        Build a single sorted page of child folders or items of ``path``.
+
+        The mapping's sidecar index is used when there is one, otherwise the
+        (cached) directory scan. Pages can be requested either by ``offset`` or
+        by the opaque ``cursor`` returned with the previous page, which resumes
+        right after its last row instead of skipping ``offset`` rows.
+
+        :param params: request parameters (name, text, recursive, offset, limit,
+            sort, sortdir, cursor). ``text`` restricts the listing to names
+            containing it (case insensitive), ``recursive`` extends that search
+            to the whole subtree.
+        :param make_doc: callable building a document from a
+            :class:`.listing.ListingEntry`. It is only called for the returned
+            rows, unless the sort key requires the full document.
+        :param folders: whether to list folders or items.
+        :param scan: result of :meth:`scan_children` to reuse instead of listing ``path``
+            again.
+        :returns: a tuple with the list of documents and the cursor of the next
+            page, or ``None`` if there is no next page.
+        """
+        name = params.get("name")
+        offset = int(params.get("offset", 0))
+        limit = int(params.get("limit", 50))
+        sort_key = params.get("sort", "lowerName")
+        reverse = int(params.get("sortdir", pymongo.ASCENDING)) == pymongo.DESCENDING
+        text = (params.get("text") or "").lower()
+        recursive = bool(text) and toBool(params.get("recursive", False))
+
+        after = None
+        if params.get("cursor"):
+            if recursive:
+                raise ValidationException(
+                    "Cursors are not supported for recursive searches.", "cursor"
+                )
+            if sort_key not in SORT_KEYS:
+                raise ValidationException(
+                    "Cursors are not supported when sorting by %s." % sort_key, "sort"
+                )
+            try:
+                after = decode_cursor(params["cursor"], sort_key, reverse)
+            except ValueError as exc:
+                raise ValidationException(str(exc), "cursor")
+            offset = 0
+
+        # Folders are sorted by the recursive size reported in their documents
+        by_total_size = folders and sort_key == "size" and folder_sizes.enabled
+        key = _listing_key(sort_key, make_doc, by_total_size)
+        index = index_registry.get(root)
+        if (
+            index is not None
+            and sort_key in index.SORT_COLUMNS
+            and not by_total_size
+        ):
+            page = index.list_children(
+                path, folders, sort_key=sort_key, reverse=reverse, offset=offset,
+                limit=limit, name=name, after=after, text=text, recursive=recursive,
+            )
+        else:
+            if name:
+                entry = lookup_entry(path, name)
+                entries = [entry] if entry and entry.is_dir == folders else []
+            elif recursive:
+                entries = search_tree(path, text, folders, scan=listing_cache.scan)
+            else:
+                entries = (scan or listing_cache.scan(path))[0 if folders else 1]
+            if text and not recursive:
+                entries = (entry for entry in entries if text in entry.name.lower())
+
+            page = select_page(
+                entries, key, reverse=reverse, offset=offset, limit=limit, after=after
+            )
+
+        next_cursor = None
+        if (
+            page
+            and limit > 0
+            and len(page) == limit
+            and sort_key in SORT_KEYS
+            and not recursive
+        ):
+            next_cursor = encode_cursor(sort_key, reverse, key(page[-1]))
+        with compact_ids.batch():
+            docs = [make_doc(entry) for entry in page]
+        return docs, next_cursor
+
+    @staticmethod
+    def check_listing(path, root, user, params, *extra):
+        """
+        End the request with a 304 if the client's copy of a listing of
+        ``path`` is still current.
+
+        The weak ETag covers the directory's inode and mtime, the request
+        parameters, the user and the mapping's access control. It changes
+        whenever entries are added, removed or renamed, but not when an existing
+        file is modified in place outside of the plugin.
+
+        :param extra: anything else the response depends on.
+        """
+        if params.get("text") and toBool(params.get("recursive", False)):
+            return  # depends on the whole subtree
+        try:
+            dir_stat = os.stat(path.as_posix())
+        except OSError:
+            return
+        check_not_modified(
+            listing_etag(
+                dir_stat,
+                sorted((key, str(value)) for key, value in params.items()),
+                str(user["_id"]) if user else None,
+                root.get("access"),
+                root.get("public"),
+                compact_ids.enabled,
+                *extra
+            )
+        )
+
+    @staticmethod
+    def count_children(path, root, scan=None):
+        """Number of folders and items directly under ``path``."""
+        if scan is None:
+            index = index_registry.get(root)
+            if index is not None:
+                return index.count_children(path)
+            scan = listing_cache.scan(path)
+        return len(scan[0]), len(scan[1])
+
     def is_file(self, path, root_id):
         if not path.is_file():
             raise ValidationException(
@@ -114,9 +349,14 @@ class VirtualObject(Resource):
                 "Invalid ObjectId: %s" % self.generate_id(path, root_id), field="id"
             )
 
-    def vFolder(self, path, root):
-        self.is_dir(path, root["_id"])
-        stat = path.stat()
+    def vFolder(self, path, root, stat=None):
+        if stat is None:
+            self.is_dir(path, root["_id"])
+            stat = path.stat()
+
+        # Recursive size when it is known already, computed in the background otherwise
+        total = folder_sizes.get(path)
+        size = total.size if total is not None else stat.st_size
 
         if path == pathlib.Path(root["fsPath"]):
             # We want actual mtime/ctime from disk
@@ -124,6 +364,8 @@ class VirtualObject(Resource):
                 "created": datetime.datetime.fromtimestamp(stat.st_ctime),
                 "updated": datetime.datetime.fromtimestamp(stat.st_mtime),
             })
+            if total is not None:
+                root["size"] = total.size
             return root
 
         if path.parent == pathlib.Path(root["fsPath"]):
@@ -134,21 +376,23 @@ class VirtualObject(Resource):
         return {
             "_id": self.generate_id(path.as_posix(), root["_id"]),
             "_modelType": "folder",
-            "access": copy.deepcopy(root.get("access", {"users": [], "groups": []})),
+            # Shared with the root, copy it before making any changes
+            "access": root.get("access", {"users": [], "groups": []}),
             "name": path.parts[-1],
             "parentId": parentId,
             "parentCollection": "folder",
             "creatorId": None,
             "created": datetime.datetime.fromtimestamp(stat.st_ctime),
             "updated": datetime.datetime.fromtimestamp(stat.st_mtime),
-            "size": stat.st_size,
+            "size": size,
             "public": root.get("public", False),
             "lowerName": path.parts[-1].lower(),
         }
 
-    def vItem(self, path, root):
-        self.is_file(path, root["_id"])
-        stat = path.stat()
+    def vItem(self, path, root, stat=None):
+        if stat is None:
+            self.is_file(path, root["_id"])
+            stat = path.stat()
         return {
             "_id": self.generate_id(path.as_posix(), root["_id"]),
             "_modelType": "item",
@@ -177,9 +421,10 @@ class VirtualObject(Resource):
             "linkTarget": os.readlink(path)
         }
 
-    def vFile(self, path, root):
-        self.is_file(path, root["_id"])
-        stat = path.stat()
+    def vFile(self, path, root, stat=None):
+        if stat is None:
+            self.is_file(path, root["_id"])
+            stat = path.stat()
         return {
             "_id": self.generate_id(path.as_posix(), root["_id"]),
             "_modelType": "file",
@@ -0,0 +1,732 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import os
+import pathlib
+import stat as stat_module
+import struct
+import tarfile
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .checksums import checksums
+from .listing import UPLOAD_PREFIX, ListingEntry, scan_directory
+
+
+class ArchiveOptions(object):
+    """Tunables of folder downloads, see ``PluginSettings.DOWNLOAD_*``."""
+
+    def __init__(self):
+        self.workers = 4
+        self.read_ahead_bytes = 64 * 1024 ** 2
+        self.block_size = 1024 ** 2
+
+    def configure(self, workers=None, read_ahead_bytes=None):
+        if workers is not None:
+            self.workers = workers
+        if read_ahead_bytes is not None:
+            self.read_ahead_bytes = read_ahead_bytes
+
+
+archive_options = ArchiveOptions()
+
+
+def walk_files(path):
+    """
+    Yield ``(entry, relative path)`` of every regular file below ``path``.
+
+    Directories are visited in name order, so the same tree always produces
+    the same sequence. Symlinked directories are followed once.
+    """
+    visited = set()
+
+    def walk(current, prefix):
+        try:
+            dir_stat = os.stat(current.as_posix())
+            if (dir_stat.st_dev, dir_stat.st_ino) in visited:
+                return  # symlink loop
+            visited.add((dir_stat.st_dev, dir_stat.st_ino))
+            folders, items = scan_directory(current)
+        except OSError:
+            return
+        for entry in sorted(items, key=lambda entry: entry.name):
+            yield entry, prefix + entry.name
+        for entry in sorted(folders, key=lambda entry: entry.name):
+            yield from walk(pathlib.Path(entry.path), prefix + entry.name + "/")
+
+    return walk(path, "")
+
+
+class _Prefetched(object):
+    __slots__ = ("chunks", "buffered", "done", "error")
+
+    def __init__(self):
+        self.chunks = collections.deque()
+        self.buffered = 0
+        self.done = False
+        self.error = None
+
+
+class ReadAhead(object):
+    """
+    Read files in a thread pool ahead of a sequential consumer.
+
+    Up to ``workers`` files are opened and read concurrently while the consumer
+    is still busy with an earlier one, which hides open and first-read latency
+    on network filesystems. All buffered data is capped by ``budget`` bytes;
+    the file being consumed may always buffer one block, so it can't be
+    starved by the files queued after it.
+
+    Iterating yields ``(item, chunks)`` in the original order, where ``chunks``
+    is a generator of the file's content that must be consumed before moving on
+    to the next item.
+
+    :param path: callable returning the path of an item, ``None`` for items
+        without content.
+    :param span: callable returning the ``(offset, length)`` of an item to read,
+        the whole file by default.
+    """
+
+    def __init__(self, items, path=lambda item: item, span=None, workers=None,
+                 budget=None, block_size=None):
+        self.items = items
+        self.path = path
+        self.span = span
+        self.workers = workers or archive_options.workers
+        self.budget = budget or archive_options.read_ahead_bytes
+        self.block_size = block_size or archive_options.block_size
+        self._cond = threading.Condition()
+        self._used = 0
+        self._head = 0
+        self._closed = False
+
+    def __iter__(self):
+        items = iter(self.items)
+        window = collections.deque()
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="read_ahead"
+        )
+        try:
+            index = 0
+            exhausted = False
+            while True:
+                while not exhausted and len(window) < self.workers + 1:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    state = _Prefetched()
+                    path = self.path(item)
+                    if path is None:
+                        state.done = True
+                    else:
+                        offset, length = self.span(item) if self.span else (0, None)
+                        executor.submit(
+                            self._read, path, offset, length, index + len(window), state
+                        )
+                    window.append((item, state))
+                if not window:
+                    break
+                item, state = window.popleft()
+                with self._cond:
+                    self._head = index
+                    self._cond.notify_all()
+                yield item, self._consume(state)
+                index += 1
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+            executor.shutdown(wait=False)
+
+    def _read(self, path, offset, length, index, state):
+        try:
+            with open(path, "rb", buffering=0) as f:
+                if offset:
+                    f.seek(offset)
+                while length is None or length > 0:
+                    with self._cond:
+                        while not self._closed and not (
+                            self._used + self.block_size <= self.budget
+                            or (index == self._head and state.buffered == 0)
+                        ):
+                            self._cond.wait()
+                        if self._closed:
+                            return
+                    size = self.block_size if length is None else min(self.block_size, length)
+                    data = f.read(size)
+                    if not data:
+                        break
+                    if length is not None:
+                        length -= len(data)
+                    with self._cond:
+                        self._used += len(data)
+                        state.buffered += len(data)
+                        state.chunks.append(data)
+                        self._cond.notify_all()
+        except Exception as exc:
+            state.error = exc
+        finally:
+            with self._cond:
+                state.done = True
+                self._cond.notify_all()
+
+    def _consume(self, state):
+        while True:
+            with self._cond:
+                while not state.chunks and not state.done:
+                    self._cond.wait()
+                if state.chunks:
+                    data = state.chunks.popleft()
+                    self._used -= len(data)
+                    state.buffered -= len(data)
+                    self._cond.notify_all()
+                elif state.error is not None:
+                    raise state.error
+                else:
+                    return
+            yield data
+
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FLAGS = 0x08 | 0x800  # sizes in a data descriptor, UTF-8 names
+
+# Extensions of formats that are compressed already
+COMPRESSED_EXTENSIONS = {
+    ".7z", ".avi", ".bz2", ".docx", ".flac", ".gif", ".gz", ".h5", ".hdf5", ".heic",
+    ".jpeg", ".jpg", ".jp2", ".lz4", ".mkv", ".mov", ".mp3", ".mp4", ".nc", ".npz",
+    ".ogg", ".parquet", ".pdf", ".png", ".pptx", ".rar", ".tgz", ".webm", ".webp",
+    ".xlsx", ".xz", ".zip", ".zst",
+}
+# Sampled data that deflates to more than this fraction of its size is stored
+SAMPLE_SIZE = 64 * 1024
+SAMPLE_RATIO = 0.9
+
+COMPRESSION_MODES = ("auto", "store", "deflate")
+# Raw deflate stream with an empty final block, closes a series of sync-flushed blocks
+DEFLATE_END = b"\x03\x00"
+
+
+def _dos_datetime(timestamp):
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return (
+        (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+        ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday,
+    )
+
+
+class ZipMember(object):
+    """A single file of a streamed zip archive, with its sizes in a data descriptor."""
+
+    def __init__(self, name, stat, method=ZIP_STORED, zip64=None):
+        self.name = name.encode("utf-8", "surrogateescape")
+        self.method = method
+        self.mode = stat.st_mode
+        self.time, self.date = _dos_datetime(stat.st_mtime)
+        # Whether the local header and data descriptor use ZIP64 sizes
+        self.zip64 = stat.st_size > 0xF0000000 if zip64 is None else zip64
+        self.offset = 0
+        self.crc = 0
+        self.compressed_size = 0
+        self.size = 0
+
+    @property
+    def version(self):
+        if self.zip64:
+            return 45
+        return 20 if self.method == ZIP_DEFLATED else 10
+
+    def local_header(self):
+        extra = struct.pack("<HHQQ", 1, 16, 0, 0) if self.zip64 else b""
+        return struct.pack(
+            "<4sHHHHHIIIHH", b"PK\x03\x04", self.version, ZIP_FLAGS, self.method,
+            self.time, self.date, 0, 0, 0, len(self.name), len(extra),
+        ) + self.name + extra
+
+    def local_header_size(self):
+        return 30 + len(self.name) + (20 if self.zip64 else 0)
+
+    def descriptor(self):
+        fmt = "<4sIQQ" if self.zip64 else "<4sIII"
+        return struct.pack(fmt, b"PK\x07\x08", self.crc, self.compressed_size, self.size)
+
+    def descriptor_size(self):
+        return 24 if self.zip64 else 16
+
+    def central_header(self):
+        extra = []
+        size, compressed_size, offset = self.size, self.compressed_size, self.offset
+        if size >= ZIP64_LIMIT:
+            extra.append(size)
+            size = ZIP64_LIMIT
+        if compressed_size >= ZIP64_LIMIT:
+            extra.append(compressed_size)
+            compressed_size = ZIP64_LIMIT
+        if offset >= ZIP64_LIMIT:
+            extra.append(offset)
+            offset = ZIP64_LIMIT
+        extra = (
+            struct.pack("<HH%dQ" % len(extra), 1, 8 * len(extra), *extra) if extra else b""
+        )
+        version = 45 if extra or self.zip64 else self.version
+        return struct.pack(
+            "<4sHHHHHHIIIHHHHHII", b"PK\x01\x02", (3 << 8) | version, version,
+            ZIP_FLAGS, self.method, self.time, self.date, self.crc, compressed_size,
+            size, len(self.name), len(extra), 0, 0, 0, (self.mode & 0xFFFF) << 16,
+            offset,
+        ) + self.name + extra
+
+
+def zip_footer(members, offset):
+    """Central directory and end records of an archive whose members end at ``offset``."""
+    directory = b"".join(member.central_header() for member in members)
+    count = len(members)
+    records = b""
+    if count >= 0xFFFF or len(directory) >= ZIP64_LIMIT or offset >= ZIP64_LIMIT:
+        eocd64_offset = offset + len(directory)
+        records = struct.pack(
+            "<4sQHHIIQQQQ", b"PK\x06\x06", 44, (3 << 8) | 45, 45, 0, 0, count, count,
+            len(directory), offset,
+        ) + struct.pack("<4sIQI", b"PK\x06\x07", 0, eocd64_offset, 1)
+    records += struct.pack(
+        "<4sHHHHIIH", b"PK\x05\x06", 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+        min(len(directory), ZIP64_LIMIT), min(offset, ZIP64_LIMIT), 0,
+    )
+    return directory + records
+
+
+def _deflate_block(data, level, zdict):
+    """
+    Deflate one block of a member independently of the others.
+
+    Each block ends with a sync flush, so the compressed blocks can simply be
+    concatenated; the preceding 32 KiB are used as a dictionary to keep most of
+    the compression ratio of a single stream.
+    """
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ZipStream(object):
+    """
+    Streamed zip archive with a per-file compression policy.
+
+    With ``compression="auto"`` files with a known compressed extension, and
+    files whose first 64 KiB don't deflate well, are stored, anything else is
+    deflated. Deflated members are split in blocks which are compressed in a
+    thread pool (``zlib`` releases the GIL) a few blocks ahead of the output,
+    across member boundaries, and stitched back in order.
+    """
+
+    def __init__(self, compression="auto", level=6, workers=None):
+        if compression not in COMPRESSION_MODES:
+            raise ValueError("Unknown compression: %s" % compression)
+        self.compression = compression
+        self.level = level
+        self.workers = workers or archive_options.workers
+        self.members = []
+        self.offset = 0
+
+    def method_for(self, name, sample):
+        if self.compression == "store" or (
+            self.compression == "auto" and not sample
+        ):
+            return ZIP_STORED
+        if self.compression == "deflate":
+            return ZIP_DEFLATED
+        if os.path.splitext(name)[1].lower() in COMPRESSED_EXTENSIONS:
+            return ZIP_STORED
+        sample = sample[:SAMPLE_SIZE]
+        if len(zlib.compress(sample, 1)) > SAMPLE_RATIO * len(sample):
+            return ZIP_STORED
+        return ZIP_DEFLATED
+
+    def generate(self, files):
+        """
+        Yield the archive.
+
+        :param files: iterable of ``((entry, name), chunks)``, see :class:`ReadAhead`
+            and :func:`walk_files`.
+        """
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="deflate"
+        )
+        pieces = self._pieces(files, executor)
+        window = collections.deque()
+        try:
+            for piece in pieces:
+                window.append(piece)
+                if len(window) > 2 * self.workers:
+                    yield self._emit(*window.popleft())
+            while window:
+                yield self._emit(*window.popleft())
+            yield zip_footer(self.members, self.offset)
+        finally:
+            pieces.close()
+            executor.shutdown(wait=False)
+
+    def _pieces(self, files, executor):
+        for (entry, name), chunks in files:
+            chunks = iter(chunks)
+            first = next(chunks, b"")
+            member = ZipMember(name, entry.stat(), self.method_for(name, first))
+            yield member, None, None
+            previous = b""
+            for data in itertools.chain([first], chunks) if first else ():
+                job = None
+                if member.method == ZIP_DEFLATED:
+                    job = executor.submit(
+                        _deflate_block, data, self.level, previous[-32768:]
+                    )
+                    previous = data
+                yield member, data, job
+            yield member, DEFLATE_END if member.method == ZIP_DEFLATED else b"", False
+
+    def _emit(self, member, data, job):
+        if data is None:
+            member.offset = self.offset
+            out = member.local_header()
+        elif job is False:
+            member.compressed_size += len(data)
+            out = data + member.descriptor()
+            self.members.append(member)
+        else:
+            out = job.result() if job is not None else data
+            member.crc = zlib.crc32(data, member.crc)
+            member.size += len(data)
+            member.compressed_size += len(out)
+        self.offset += len(out)
+        return out
+
+
+def _file_crc(path, stat, block_size):
+    crc, size = 0, stat.st_size
+    with open(path, "rb", buffering=0) as f:
+        while size > 0:
+            data = f.read(min(block_size, size))
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+            size -= len(data)
+    if size:
+        raise IOError("%s changed during the download" % path)
+    checksums.store_crc32(path, stat, crc)
+    return crc
+
+
+class StoredZip(object):
+    """
+    Zip archive of stored members whose layout is known before streaming.
+
+    Every offset and the total size follow from a stat pass over the files,
+    so any byte range of the archive can be produced on its own: members
+    before the range are skipped, and the one it starts in is read from the
+    right offset. CRCs of members that aren't streamed in full, but whose
+    data descriptor or central directory entry is, are computed in a thread
+    pool, unless they are known from an earlier download, see
+    :meth:`.checksums.Checksums.crc32`. The archive stays the same as long
+    as the stat of its files does, see :attr:`etag`.
+
+    :param files: iterable of ``(entry, name)``, see :func:`walk_files`.
+    """
+
+    def __init__(self, files, workers=None):
+        self.workers = workers or archive_options.workers
+        self.members = []
+        validator = hashlib.sha1()
+        offset = 0
+        for entry, name in files:
+            stat = entry.stat()
+            member = ZipMember(name, stat, ZIP_STORED, zip64=stat.st_size >= ZIP64_LIMIT)
+            member.offset = offset
+            member.size = member.compressed_size = stat.st_size
+            start = offset + member.local_header_size()
+            offset = start + member.size + member.descriptor_size()
+            self.members.append((member, entry.path, start, stat))
+            validator.update(repr(
+                (member.name, stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_mode)
+            ).encode("utf-8"))
+        self.directory_offset = offset
+        # CRCs are fixed size, the footer's length doesn't depend on them
+        self.size = offset + len(
+            zip_footer([member for member, _, _, _ in self.members], offset)
+        )
+        self.etag = '"%s-%x"' % (validator.hexdigest(), self.size)
+
+    def generate(self, start=0, end=None):
+        """Yield the bytes ``[start, end)`` of the archive."""
+        end = self.size if end is None else min(end, self.size)
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="zip_crc"
+        )
+        try:
+            yield from self._generate(start, end, executor)
+        finally:
+            executor.shutdown(wait=False)
+
+    def _plan(self, start, end, executor):
+        """Members of ``[start, end)``, and the CRCs it needs besides theirs."""
+        block_size = archive_options.block_size
+        with_directory = end > self.directory_offset
+        streamed = []  # (member, path, data offset, data start, data end, stat)
+        pending = {}  # CRCs by member id, known or computed in the background
+        for member, path, data_offset, stat in self.members:
+            data_end = data_offset + member.size
+            if member.offset >= end:
+                break
+            if data_end + member.descriptor_size() > start:
+                streamed.append((
+                    member, path, data_offset,
+                    max(start, data_offset), min(end, data_end), stat,
+                ))
+            # The CRC is needed, but won't be computed from streamed data
+            needs_crc = with_directory or data_end < end
+            if needs_crc and not (start <= data_offset and data_end <= end):
+                crc = checksums.crc32(path, stat)
+                if crc is None:
+                    crc = executor.submit(_file_crc, path, stat, block_size)
+                pending[id(member)] = crc
+        return streamed, pending
+
+    def _generate(self, start, end, executor):
+        with_directory = end > self.directory_offset
+        streamed, pending = self._plan(start, end, executor)
+
+        def known_crc(member):
+            crc = pending.pop(id(member))
+            return crc if isinstance(crc, int) else crc.result()
+
+        def span(item):
+            member, _, data_offset, data_start, data_end, _ = item
+            return data_start - data_offset, max(0, data_end - data_start)
+
+        files = ReadAhead(streamed, path=lambda item: item[1], span=span)
+        for (member, path, data_offset, data_start, data_end, stat), chunks in files:
+            yield from _slice(member.local_header(), member.offset, start, end)
+            crc, length = 0, 0
+            for data in chunks:
+                crc = zlib.crc32(data, crc)
+                length += len(data)
+                yield data
+            if length != max(0, data_end - data_start):
+                raise IOError("%s changed during the download" % path)
+            if data_start == data_offset and length == member.size:
+                checksums.store_crc32(path, stat, crc)
+            descriptor_offset = data_offset + member.size
+            if descriptor_offset < end:
+                member.crc = known_crc(member) if id(member) in pending else crc
+                yield from _slice(member.descriptor(), descriptor_offset, start, end)
+        if with_directory:
+            for member, _, _, _ in self.members:
+                if id(member) in pending:
+                    member.crc = known_crc(member)
+            footer = zip_footer(
+                [member for member, _, _, _ in self.members], self.directory_offset
+            )
+            yield from _slice(footer, self.directory_offset, start, end)
+
+
+def _slice(data, offset, start, end):
+    """Part of ``data``, found at ``offset`` in the archive, within ``[start, end)``."""
+    data = data[max(0, start - offset):max(0, end - offset)]
+    if data:
+        yield data
+
+
+# Download formats, with the compression of tar archives
+ARCHIVE_FORMATS = {"zip": None, "tar": None, "tar.gz": "gz", "tar.zst": "zst"}
+ARCHIVE_CONTENT_TYPES = {
+    "zip": "application/zip",
+    "tar": "application/x-tar",
+    "tar.gz": "application/gzip",
+    "tar.zst": "application/zstd",
+}
+
+
+def walk_tree(path):
+    """
+    Yield ``(path, relative path, lstat)`` of every file, symlink and directory
+    below ``path``.
+
+    Symlinks aren't followed. Like :func:`walk_files`, the files of a
+    directory come first, in name order, then each subdirectory followed by
+    its content.
+    """
+
+    def walk(current, prefix):
+        try:
+            with os.scandir(current) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            return
+        folders = []
+        for entry in entries:
+            if entry.name.startswith(UPLOAD_PREFIX):
+                continue
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue  # removed during the walk
+            if stat_module.S_ISDIR(stat.st_mode):
+                folders.append((entry, stat))
+            elif stat_module.S_ISREG(stat.st_mode) or stat_module.S_ISLNK(stat.st_mode):
+                yield entry.path, prefix + entry.name, stat
+        for entry, stat in folders:
+            yield entry.path, prefix + entry.name, stat
+            yield from walk(entry.path, prefix + entry.name + "/")
+
+    return walk(path.as_posix(), "")
+
+
+class TarStream(object):
+    """
+    Streamed POSIX (pax) tar archive, optionally gzip or zstd compressed.
+
+    Modes, modification times and symlinks are preserved; ownership isn't,
+    it means nothing outside of the server. Regular files are stored with the
+    size they had when walked, or were recorded with: content that is longer
+    is cut, content that is shorter is padded with zeros, as GNU tar does.
+    """
+
+    def __init__(self, compression=None, level=6):
+        if compression not in (None, "gz", "zst"):
+            raise ValueError("Unknown compression: %s" % compression)
+        if compression == "zst" and zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        self.compression = compression
+        self.level = level
+
+    def generate(self, files):
+        """
+        Yield the archive.
+
+        :param files: iterable of ``((path, name, stat), chunks)``, see
+            :class:`ReadAhead` and :func:`walk_tree`.
+        """
+        if self.compression == "gz":
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif self.compression == "zst":
+            compressor = zstandard.ZstdCompressor(level=self.level).compressobj()
+        else:
+            yield from self._blocks(files)
+            return
+        for data in self._blocks(files):
+            data = compressor.compress(data)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    @staticmethod
+    def member(path, name, stat):
+        info = tarfile.TarInfo(name)
+        info.mode = stat_module.S_IMODE(stat.st_mode)
+        info.mtime = stat.st_mtime
+        if stat_module.S_ISDIR(stat.st_mode):
+            info.type = tarfile.DIRTYPE
+        elif stat_module.S_ISLNK(stat.st_mode):
+            info.type = tarfile.SYMTYPE
+            info.linkname = os.readlink(path)
+        else:
+            info.size = stat.st_size
+        return info
+
+    def _blocks(self, files):
+        offset = 0
+        for (path, name, stat), chunks in files:
+            try:
+                info = self.member(path, name, stat)
+            except OSError:
+                continue  # symlink removed during the walk
+            header = info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+            yield header
+            remaining = info.size
+            for data in chunks:
+                # Content that doesn't match its recorded size, e.g. from a
+                # Girder file, must not shift the members after it
+                if len(data) > remaining:
+                    data = data[:remaining]
+                remaining -= len(data)
+                if data:
+                    yield data
+            while remaining > 0:
+                padding = min(remaining, archive_options.block_size)
+                remaining -= padding
+                yield bytes(padding)
+            padding = -info.size % tarfile.BLOCKSIZE
+            offset += len(header) + info.size + padding
+            if padding:
+                yield bytes(padding)
+        # Two empty blocks, then the rest of the last record
+        end = 2 * tarfile.BLOCKSIZE
+        end += -(offset + end) % tarfile.RECORDSIZE
+        yield bytes(end)
+
+
+def tar_files(path):
+    """Walk ``path`` for a :class:`TarStream`, reading regular files ahead."""
+
+    def content(item):
+        return item[0] if stat_module.S_ISREG(item[2].st_mode) else None
+
+    def span(item):
+        return 0, item[2].st_size
+
+    return ReadAhead(walk_tree(path), path=content, span=span)
+
+
+def content_stat(size, mtime, mode=stat_module.S_IFREG | 0o644):
+    """Stat of an archive member that doesn't come from the filesystem."""
+    return os.stat_result((mode, 0, 0, 1, 0, 0, size, mtime, mtime, mtime))
+
+
+def read_records(records, archive="zip"):
+    """
+    Read the content of archive members ahead, for a :class:`ZipStream` or a
+    :class:`TarStream`.
+
+    :param records: iterable of ``(path, name, stat, source)``, where ``source``
+        is ``None`` for files read from ``path``, or a callable returning the
+        content's chunks otherwise.
+    :param archive: format of the archive, zip archives only get regular files.
+    """
+    if archive == "zip":
+        records = (
+            record for record in records if stat_module.S_ISREG(record[2].st_mode)
+        )
+
+    def content(record):
+        path, _, stat, source = record
+        return path if source is None and stat_module.S_ISREG(stat.st_mode) else None
+
+    def span(record):
+        return 0, record[2].st_size
+
+    for (path, name, stat, source), chunks in ReadAhead(
+        records, path=content, span=span
+    ):
+        if source is not None:
+            chunks = (
+                data.encode("utf-8") if isinstance(data, str) else data
+                for data in source()
+            )
+        if archive == "zip":
+            yield (ListingEntry(name, path, False, stat), name), chunks
+        else:
+            yield (path, name, stat), chunks
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import collections
+import hashlib
+import os
+import pathlib
+import threading
+import uuid
+
+
+class ArchiveCache(object):
+    """
+    On-disk cache of generated folder archives.
+
+    Archives are content addressed: the key is a digest of the archived
+    directory and its mapping, the relative path, size, mtime and mode of
+    everything in the tree, plus the archive format and options. Any change
+    under the tree gives a new key, so a stale archive is simply never looked
+    up again; :meth:`invalidate` also drops it right away when the plugin
+    itself changes the tree. The least recently used archives are removed to
+    keep the cache under ``max_bytes``.
+    """
+
+    def __init__(self, max_bytes=10 * 1024 ** 3):
+        self.root = None
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key -> (size, directory the archive was made of)
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.root is not None and self.max_bytes > 0
+
+    def configure(self, root=None, max_bytes=None):
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        root = pathlib.Path(root) if root else None
+        with self._lock:
+            if root != self.root:
+                self.root = root
+                self._entries.clear()
+                self._bytes = 0
+                if root is not None:
+                    self._load()
+            self._evict()
+
+    @staticmethod
+    def key(source, root_id, tree, *options):
+        """
+        Key of an archive.
+
+        :param source: the archived directory. Member names are relative, so
+            different directories with matching trees must not share a key.
+        :param root_id: id of the mapping the directory belongs to.
+        :param tree: iterable of ``(relative path, stat)`` of the archived tree.
+        :param options: archive format first, then anything else affecting the
+            archive's content.
+        """
+        digest = hashlib.sha256(
+            repr((os.fspath(source), str(root_id)) + options).encode(
+                "utf-8", "surrogateescape"
+            )
+        )
+        for name, stat in tree:
+            digest.update(repr(
+                (name, stat.st_size, stat.st_mtime_ns, stat.st_mode)
+            ).encode("utf-8", "surrogateescape"))
+        return "%s.%s" % (digest.hexdigest(), options[0])
+
+    def path(self, key):
+        return self.root / key[:2] / key
+
+    def lookup(self, key):
+        """:returns: the path of the cached archive, or ``None``."""
+        path = self.path(key)
+        try:
+            os.utime(path.as_posix())  # recency survives restarts
+        except OSError:
+            with self._lock:
+                self.misses += 1
+                self._forget(key)
+            return None
+        with self._lock:
+            self.hits += 1
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return path
+
+    def store(self, key, source, chunks, current_key):
+        """
+        Pass ``chunks`` of the archive of ``source`` through, writing them to
+        the cache.
+
+        The archive is only kept if it was generated completely, it fits in
+        the cache and ``current_key()`` still gives ``key`` afterwards, that is
+        if the tree didn't change meanwhile.
+        """
+        path = self.path(key)
+        tmp = path.parent / (".tmp-" + uuid.uuid4().hex)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        size = 0
+        fp = open(tmp.as_posix(), "wb")
+        try:
+            for data in chunks:
+                if fp is not None:
+                    size += len(data)
+                    if size > self.max_bytes:
+                        fp.close()
+                        fp = None
+                        os.unlink(tmp.as_posix())
+                    else:
+                        fp.write(data)
+                yield data
+            if fp is not None:
+                fp.close()
+                fp = None
+                if current_key() == key:
+                    os.rename(tmp.as_posix(), path.as_posix())
+                    with self._lock:
+                        self._add(key, size, source)
+                        self._evict()
+                else:
+                    os.unlink(tmp.as_posix())
+        finally:
+            if fp is not None:
+                fp.close()
+                os.unlink(tmp.as_posix())
+
+    def invalidate(self, path):
+        """Drop the archives of ``path`` and of the directories containing it."""
+        path = pathlib.Path(path)
+        with self._lock:
+            stale = [
+                key
+                for key, (_, source) in self._entries.items()
+                if source is not None and (source == path or source in path.parents)
+            ]
+            for key in stale:
+                self._remove(key)
+
+    def invalidate_event(self, event):
+        for path in event.info:
+            self.invalidate(path)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "maxBytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _load(self):
+        """Pick up archives left by an earlier run, oldest first."""
+        found = []
+        try:
+            buckets = list(os.scandir(self.root.as_posix()))
+        except OSError:
+            return
+        for bucket in buckets:
+            if not bucket.is_dir():
+                continue
+            with os.scandir(bucket.path) as it:
+                for entry in it:
+                    if entry.name.startswith(".tmp-") or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    found.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, key, size in sorted(found):
+            self._add(key, size, None)
+
+    def _add(self, key, size, source):
+        self._forget(key)
+        self._entries[key] = (size, source)
+        self._bytes += size
+
+    def _forget(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[0]
+
+    def _remove(self, key):
+        self._forget(key)
+        try:
+            os.unlink(self.path(key).as_posix())
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self._entries and self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+
+archive_cache = ArchiveCache()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import zlib
+
+
+CHECKSUM_ALGORITHMS = ("sha256", "md5")
+XATTR_NAME = "user.wholetale.checksums"
+
+
+def file_version(stat):
+    """Identifies a version of a file's content, see :class:`Checksums`."""
+    return "%x-%x-%x" % (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class Checksums(object):
+    """
+    Content checksums of files, computed once per version of a file.
+
+    A version is the inode, size and mtime of a file, which all stay the same
+    as long as its content does, so checking an unchanged tree only costs a
+    stat per file. Checksums are kept in an extended attribute of the file
+    when the filesystem allows it, so they survive restarts, and in a bounded
+    LRU otherwise. Files are hashed in a thread pool, ``hashlib`` releases the
+    GIL while hashing. The CRC32 of zip archives is kept alongside, see
+    :meth:`crc32`.
+    """
+
+    def __init__(self, workers=2, max_entries=100000, block_size=1024 ** 2):
+        self.workers = workers
+        self.max_entries = max_entries
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._data = collections.OrderedDict()
+        self._crcs = collections.OrderedDict()
+        self._pending = {}
+        self._executor = None
+        self.hashed = 0
+        self.hashed_bytes = 0
+
+    def configure(self, workers=None):
+        with self._lock:
+            if workers is not None and workers != self.workers:
+                self.workers = workers
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                    self._executor = None
+
+    def get(self, path, stat=None, wait=0):
+        """
+        Checksums of a file.
+
+        :param path: path of the file.
+        :param stat: its stat, if the caller has it already.
+        :param wait: how long to wait, in seconds, for checksums that aren't
+            known yet. They are computed in the background either way.
+        :returns: a dict of hex digests by algorithm, empty if they aren't
+            known yet.
+        """
+        path = os.fspath(path)
+        if stat is None:
+            stat = os.stat(path)
+        version = file_version(stat)
+        known = self._lookup(path, version)
+        if known is not None:
+            return dict(known)
+        future = self.schedule(path, version)
+        if not wait:
+            return {}
+        try:
+            return dict(future.result(timeout=wait))
+        except concurrent.futures.TimeoutError:
+            return {}
+
+    def crc32(self, path, stat):
+        """Known CRC32 of a version of a file, or None."""
+        path = os.fspath(path)
+        version = file_version(stat)
+        with self._lock:
+            crc = self._crcs.get((path, version))
+            if crc is not None:
+                self._crcs.move_to_end((path, version))
+                return crc
+        crc = (self._read(path, version) or {}).get("crc32")
+        if not isinstance(crc, int):
+            return None
+        self._store_crc32(path, version, crc)
+        return crc
+
+    def store_crc32(self, path, stat, crc):
+        """
+        Keep the CRC32 of a version of a file, computed by the caller from
+        its content. It's dropped if the file has changed since ``stat``.
+        """
+        path = os.fspath(path)
+        version = file_version(stat)
+        try:
+            if file_version(os.stat(path)) != version:
+                return
+        except OSError:
+            return
+        self._store_crc32(path, version, crc)
+        stored = self._read(path, version) or {"version": version}
+        if stored.get("crc32") != crc:
+            self._write(path, dict(stored, crc32=crc))
+
+    def schedule(self, path, version):
+        key = (path, version)
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None:
+                if self._executor is None:
+                    self._executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=self.workers, thread_name_prefix="checksums"
+                    )
+                future = self._executor.submit(self._compute, path, version)
+                self._pending[key] = future
+        return future
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "crcEntries": len(self._crcs),
+                "pending": len(self._pending),
+                "hashed": self.hashed,
+                "hashedBytes": self.hashed_bytes,
+            }
+
+    def _lookup(self, path, version):
+        with self._lock:
+            known = self._data.get((path, version))
+            if known is not None:
+                self._data.move_to_end((path, version))
+                return known
+        stored = self._read(path, version)
+        if stored is None:
+            return None
+        known = {name: stored.get(name) for name in CHECKSUM_ALGORITHMS}
+        if None in known.values():
+            return None
+        self._store(path, version, known)
+        return known
+
+    def _compute(self, path, version):
+        try:
+            digests = {name: hashlib.new(name) for name in CHECKSUM_ALGORITHMS}
+            crc, size = 0, 0
+            with open(path, "rb", buffering=0) as f:
+                while True:
+                    data = f.read(self.block_size)
+                    if not data:
+                        break
+                    size += len(data)
+                    crc = zlib.crc32(data, crc)
+                    for digest in digests.values():
+                        digest.update(data)
+            known = {name: digest.hexdigest() for name, digest in digests.items()}
+            with self._lock:
+                self.hashed += 1
+                self.hashed_bytes += size
+            # A file changed while it was read has no valid checksum to keep
+            if file_version(os.stat(path)) == version:
+                self._store(path, version, known)
+                self._store_crc32(path, version, crc)
+                self._write(path, dict(known, crc32=crc, version=version))
+            return known
+        finally:
+            with self._lock:
+                self._pending.pop((path, version), None)
+
+    @staticmethod
+    def _read(path, version):
+        """What the xattr of a file holds for ``version``, or None."""
+        try:
+            stored = json.loads(os.getxattr(path, XATTR_NAME).decode("utf-8"))
+        except (AttributeError, OSError, ValueError):
+            return None  # no xattr support, or nothing stored
+        if not isinstance(stored, dict) or stored.get("version") != version:
+            return None
+        return stored
+
+    @staticmethod
+    def _write(path, value):
+        try:
+            os.setxattr(path, XATTR_NAME, json.dumps(value).encode("utf-8"))
+        except (AttributeError, OSError):
+            pass
+
+    def _store_crc32(self, path, version, crc):
+        with self._lock:
+            self._crcs[(path, version)] = crc
+            self._crcs.move_to_end((path, version))
+            while len(self._crcs) > self.max_entries:
+                self._crcs.popitem(last=False)
+
+    def _store(self, path, version, known):
+        with self._lock:
+            self._data[(path, version)] = known
+            self._data.move_to_end((path, version))
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+
+checksums = Checksums()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import email.utils
+import hashlib
+
+import cherrypy
+from cherrypy.lib import httputil
+
+from girder.api.rest import setResponseHeader
+
+
+def file_etag(stat):
+    """Strong validator of a file's content, changes with any write or replacement."""
+    return '"%x-%x-%x"' % (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def listing_etag(dir_stat, *parts):
+    """
+    Weak validator of a directory listing.
+
+    :param dir_stat: stat of the directory, its inode and mtime change whenever
+        an entry is added, removed or renamed.
+    :param parts: anything else the response depends on.
+    """
+    key = repr((dir_stat.st_ino, dir_stat.st_mtime_ns) + parts)
+    return 'W/"%s"' % hashlib.sha1(key.encode("utf-8", "surrogateescape")).hexdigest()
+
+
+def _opaque_tags(header):
+    """Opaque parts of the entity tags in an If-None-Match/If-Range header."""
+    tags = []
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag:
+            tags.append(tag)
+    return tags
+
+
+def _opaque(etag):
+    return etag[2:] if etag.startswith("W/") else etag
+
+
+def _parse_date(value):
+    try:
+        parsed = email.utils.parsedate_tz(value)
+        return email.utils.mktime_tz(parsed) if parsed else None
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def check_not_modified(etag, mtime=None):
+    """
+    Set the validators of the response and end it with a 304 if the client's
+    copy is still current.
+
+    ``If-None-Match`` is compared weakly and takes precedence over
+    ``If-Modified-Since`` (RFC 7232, section 6).
+
+    :param etag: entity tag of the current representation.
+    :param mtime: modification time, to send ``Last-Modified``.
+    :raises cherrypy.HTTPRedirect: with status 304.
+    """
+    setResponseHeader("ETag", etag)
+    if mtime is not None:
+        setResponseHeader("Last-Modified", httputil.HTTPDate(mtime))
+
+    headers = cherrypy.request.headers
+    if_none_match = headers.get("If-None-Match")
+    if if_none_match is not None:
+        tags = _opaque_tags(if_none_match)
+        not_modified = "*" in tags or _opaque(etag) in tags
+    elif mtime is not None and headers.get("If-Modified-Since"):
+        since = _parse_date(headers["If-Modified-Since"])
+        not_modified = since is not None and int(mtime) <= since
+    else:
+        not_modified = False
+
+    if not_modified and cherrypy.request.method in ("GET", "HEAD"):
+        raise cherrypy.HTTPRedirect([], 304)
+
+
+def range_applies(etag, mtime=None):
+    """
+    Whether the ``Range`` header should be honoured, given ``If-Range``.
+
+    An entity tag must match strongly, a date must equal the last
+    modification time (RFC 7233, section 3.2). Without ``mtime`` only entity
+    tags can match.
+    """
+    if_range = cherrypy.request.headers.get("If-Range")
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return if_range == etag and not etag.startswith("W/")
+    return mtime is not None and _parse_date(if_range) == int(mtime)
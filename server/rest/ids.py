@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import base64
+import collections
+import contextlib
+import hashlib
+import threading
+
+from pymongo import UpdateOne
+
+from ..models.virtual_id import VirtualId
+
+
+COMPACT_PREFIX = "wtlocal:~"
+
+
+class CompactIds(object):
+    """
+    Fixed-length virtual object ids.
+
+    An id is a hash of the mapping root id and the path relative to the
+    mapping, the pair is stored in :class:`VirtualId` so it can be resolved
+    again by any server process. Recently used ids are kept in an LRU, which
+    also remembers which ids have been stored already.
+    """
+
+    def __init__(self, max_entries=100000):
+        self.enabled = False
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._known = collections.OrderedDict()
+        self._local = threading.local()
+
+    def configure(self, enabled):
+        self.enabled = bool(enabled)
+
+    def generate(self, root_id, rel):
+        root_id = str(root_id)
+        digest = hashlib.sha256((root_id + "|" + rel).encode()).digest()[:16]
+        key = base64.urlsafe_b64encode(digest).decode().rstrip("=")
+        with self._lock:
+            stored = key in self._known
+            if stored:
+                self._known.move_to_end(key)
+        if not stored:
+            self._store(key, root_id, rel)
+        return COMPACT_PREFIX + key
+
+    def resolve(self, object_id):
+        """:returns: ``(root_id, rel)`` or ``None`` if the id is unknown."""
+        key = object_id[len(COMPACT_PREFIX):]
+        with self._lock:
+            known = self._known.get(key)
+        if known is not None:
+            return known
+        doc = VirtualId().load(key, force=True, objectId=False)
+        if doc is None:
+            return None
+        self._remember(key, doc["rootId"], doc["path"])
+        return doc["rootId"], doc["path"]
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Store the ids generated within the block with a single bulk write."""
+        if getattr(self._local, "pending", None) is not None:
+            yield
+            return
+        self._local.pending = {}
+        try:
+            yield
+            pending = self._local.pending
+        finally:
+            self._local.pending = None
+        if pending:
+            VirtualId().collection.bulk_write(
+                [
+                    UpdateOne(
+                        {"_id": key},
+                        {"$setOnInsert": {"rootId": root_id, "path": rel}},
+                        upsert=True,
+                    )
+                    for key, (root_id, rel) in pending.items()
+                ],
+                ordered=False,
+            )
+            for key, (root_id, rel) in pending.items():
+                self._remember(key, root_id, rel)
+
+    def forget_root(self, root_id):
+        """Drop every id of a mapping that is being removed."""
+        root_id = str(root_id)
+        with self._lock:
+            for key in [k for k, v in self._known.items() if v[0] == root_id]:
+                del self._known[key]
+        VirtualId().removeWithQuery({"rootId": root_id})
+
+    def _store(self, key, root_id, rel):
+        pending = getattr(self._local, "pending", None)
+        if pending is not None:
+            pending[key] = (root_id, rel)
+            return
+        VirtualId().collection.update_one(
+            {"_id": key},
+            {"$setOnInsert": {"rootId": root_id, "path": rel}},
+            upsert=True,
+        )
+        self._remember(key, root_id, rel)
+
+    def _remember(self, key, root_id, rel):
+        with self._lock:
+            self._known[key] = (root_id, rel)
+            self._known.move_to_end(key)
+            while len(self._known) > self.max_entries:
+                self._known.popitem(last=False)
+
+
+compact_ids = CompactIds()
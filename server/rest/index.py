@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import pathlib
+import sqlite3
+import stat as stat_module
+import threading
+
+from .listing import ListingEntry, lookup_entry, scan_directory
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    ino INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    parent TEXT NOT NULL,
+    name TEXT NOT NULL,
+    lowerName TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    updated REAL NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (parent, name)
+);
+CREATE INDEX IF NOT EXISTS entries_lowername ON entries (parent, kind, lowerName, name);
+CREATE INDEX IF NOT EXISTS entries_size ON entries (parent, kind, size, name);
+CREATE INDEX IF NOT EXISTS entries_updated ON entries (parent, kind, updated, name);
+"""
+
+
+# Trigram index over lowerName used for substring searches (SQLite >= 3.34)
+TRIGRAM_SCHEMA = """
+CREATE VIRTUAL TABLE entries_trigram USING fts5(
+    lowerName, content='entries', content_rowid='rowid', tokenize='trigram'
+);
+CREATE TRIGGER entries_trigram_insert AFTER INSERT ON entries BEGIN
+    INSERT INTO entries_trigram (rowid, lowerName) VALUES (new.rowid, new.lowerName);
+END;
+CREATE TRIGGER entries_trigram_delete AFTER DELETE ON entries BEGIN
+    INSERT INTO entries_trigram (entries_trigram, rowid, lowerName)
+    VALUES ('delete', old.rowid, old.lowerName);
+END;
+INSERT INTO entries_trigram (entries_trigram) VALUES ('rebuild');
+"""
+
+
+def _subtree_range(rel):
+    """
+    Bounds of the paths below ``rel``: ``'0'`` sorts right after ``'/'``.
+
+    Unlike ``LIKE``, which ignores ASCII case, this is an exact match that can
+    use the primary keys.
+    """
+    return rel + "/", rel + "0"
+
+
+def _child_relpath(parent, name):
+    return "%s/%s" % (parent, name) if parent else name
+
+
+class MappingIndex(object):
+    """
+    Persistent SQLite index of the tree under a single mapping.
+
+    Each directory is stored together with the ``st_mtime_ns``/``st_ino`` it had
+    when it was indexed. Queries first compare that against the disk and rescan
+    the directory only when it changed, so on an unchanged tree a listing is
+    one ``stat`` plus an indexed query.
+    """
+
+    # Sort keys that map directly onto indexed columns
+    SORT_COLUMNS = {
+        "name": "name",
+        "lowerName": "lowerName",
+        "size": "size",
+        "created": "created",
+        "updated": "updated",
+    }
+
+    def __init__(self, db_path, root_path):
+        self.db_path = db_path
+        self.root_path = pathlib.Path(root_path)
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(SCHEMA)
+            self.has_trigram = bool(
+                conn.execute(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'entries_trigram'"
+                ).fetchone()
+            )
+            if not self.has_trigram:
+                try:
+                    conn.executescript(TRIGRAM_SCHEMA)
+                    self.has_trigram = True
+                except sqlite3.OperationalError:
+                    # No FTS5 or trigram tokenizer, searches fall back to instr()
+                    pass
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _relpath(self, path):
+        rel = pathlib.Path(path).relative_to(self.root_path).as_posix()
+        return "" if rel == "." else rel
+
+    def refresh(self, path, dir_stat=None):
+        """Rescan a single directory and replace its rows."""
+        if dir_stat is None:
+            dir_stat = os.stat(path.as_posix())
+        folders, items = scan_directory(path)
+        rows = []
+        for kind, entries in (("folder", folders), ("item", items)):
+            for entry in entries:
+                try:
+                    entry.name.encode()
+                    stat = entry.stat()
+                except (OSError, UnicodeEncodeError):
+                    # Gone already, or a name that is not valid UTF-8
+                    continue
+                rows.append((
+                    entry.name, entry.name.lower(), kind,
+                    stat.st_size, stat.st_mtime, stat.st_ctime,
+                ))
+
+        parent = self._relpath(path)
+        names = {row[0] for row in rows if row[2] == "folder"}
+        with self._connection() as conn:
+            # Subdirectories that went away take their subtree along
+            for (name,) in conn.execute(
+                "SELECT name FROM entries WHERE parent = ? AND kind = 'folder'", (parent,)
+            ).fetchall():
+                if name not in names:
+                    self._forget_tree(conn, _child_relpath(parent, name))
+            conn.execute("DELETE FROM entries WHERE parent = ?", (parent,))
+            conn.executemany(
+                "INSERT INTO entries (parent, name, lowerName, kind, size, updated, "
+                "created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((parent,) + row for row in rows),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO dirs (path, mtime_ns, ino) VALUES (?, ?, ?)",
+                (parent, dir_stat.st_mtime_ns, dir_stat.st_ino),
+            )
+        return folders
+
+    @staticmethod
+    def _forget_tree(conn, rel):
+        """Delete the rows of ``rel`` and of everything below it."""
+        start, end = _subtree_range(rel)
+        conn.execute(
+            "DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)",
+            (rel, start, end),
+        )
+        conn.execute(
+            "DELETE FROM entries WHERE parent = ? OR (parent >= ? AND parent < ?)",
+            (rel, start, end),
+        )
+
+    def ensure_fresh(self, path):
+        """
+        Rescan ``path`` if it changed since it was indexed.
+
+        :returns: the directory's stat.
+        """
+        dir_stat = os.stat(path.as_posix())
+        row = (
+            self._connection()
+            .execute(
+                "SELECT mtime_ns, ino FROM dirs WHERE path = ?", (self._relpath(path),)
+            )
+            .fetchone()
+        )
+        if row != (dir_stat.st_mtime_ns, dir_stat.st_ino):
+            self.refresh(path, dir_stat=dir_stat)
+        return dir_stat
+
+    def ensure_fresh_tree(self, path):
+        """
+        Rescan the directories below ``path`` that changed, or were never
+        indexed, since they were last indexed.
+
+        This costs a ``stat`` per directory, files are only read again in the
+        directories that changed.
+        """
+        visited = set()
+        stack = [path]
+        while stack:
+            current = stack.pop()
+            try:
+                dir_stat = self.ensure_fresh(current)
+            except OSError:
+                if current == path:
+                    raise
+                with self._connection() as conn:
+                    self._forget_tree(conn, self._relpath(current))
+                continue
+            if (dir_stat.st_dev, dir_stat.st_ino) in visited:
+                continue  # symlink loop
+            visited.add((dir_stat.st_dev, dir_stat.st_ino))
+            stack.extend(
+                current / name
+                for (name,) in self._connection().execute(
+                    "SELECT name FROM entries WHERE parent = ? AND kind = 'folder'",
+                    (self._relpath(current),),
+                )
+            )
+
+    def build(self):
+        """Index the whole tree below the mapping root."""
+        stack = [self.root_path]
+        while stack:
+            path = stack.pop()
+            try:
+                folders = self.refresh(path)
+            except OSError:
+                continue
+            stack.extend(pathlib.Path(entry.path) for entry in folders)
+
+    def invalidate(self, path):
+        """
+        Bring the index up to date after the plugin created, changed or removed
+        ``path``.
+
+        The row of ``path`` is replaced in its parent directory, which keeps its
+        other rows and is stamped with its new mtime instead of being rescanned
+        as a whole. ``path`` itself and anything below it are rescanned on next
+        use. Changes made to the parent directory outside of the plugin since it
+        was last scanned are only picked up with its next change.
+        """
+        try:
+            rel = self._relpath(path)
+        except ValueError:
+            return
+        with self._connection() as conn:
+            if not rel:
+                conn.execute("DELETE FROM dirs WHERE path = ''")
+                return
+            entry = lookup_entry(path.parent, path.name)
+            self._update_entry(conn, path, entry)
+            if entry is not None and entry.is_dir:
+                conn.execute("DELETE FROM dirs WHERE path = ?", (rel,))
+            else:
+                self._forget_tree(conn, rel)
+
+    def _update_entry(self, conn, path, entry):
+        """Replace the row of ``path`` in its parent with ``entry``."""
+        parent = self._relpath(path.parent)
+        row = conn.execute(
+            "SELECT mtime_ns, ino FROM dirs WHERE path = ?", (parent,)
+        ).fetchone()
+        if row is None:
+            return  # not indexed yet
+        try:
+            dir_stat = os.stat(path.parent.as_posix())
+        except OSError:
+            dir_stat = None
+        if dir_stat is None or dir_stat.st_ino != row[1]:
+            conn.execute("DELETE FROM dirs WHERE path = ?", (parent,))
+            return
+
+        conn.execute(
+            "DELETE FROM entries WHERE parent = ? AND name = ?", (parent, path.name)
+        )
+        if entry is not None:
+            try:
+                entry.name.encode()
+                stat = entry.stat()
+            except (OSError, UnicodeEncodeError):
+                stat = None
+            if stat is not None:
+                conn.execute(
+                    "INSERT INTO entries (parent, name, lowerName, kind, size, updated, "
+                    "created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        parent, entry.name, entry.name.lower(),
+                        "folder" if entry.is_dir else "item",
+                        stat.st_size, stat.st_mtime, stat.st_ctime,
+                    ),
+                )
+        conn.execute(
+            "UPDATE dirs SET mtime_ns = ? WHERE path = ?", (dir_stat.st_mtime_ns, parent)
+        )
+
+    def list_children(
+        self, path, folders, sort_key="lowerName", reverse=False, offset=0, limit=0,
+        name=None, after=None, text=None, recursive=False,
+    ):
+        """
+        A single sorted page of children of ``path``.
+
+        :param after: ``(key, name)`` to seek past, see
+            :func:`.listing.decode_cursor`.
+        :param text: only return entries whose lowercased name contains it. The
+            trigram index is used for the lookup when available.
+        :param recursive: search the whole subtree instead of direct children.
+            Directories of the subtree that changed are rescanned first.
+        :returns: a list of :class:`.listing.ListingEntry`, stat'ed from the
+            disk.
+        """
+        if recursive:
+            self.ensure_fresh_tree(path)
+        else:
+            self.ensure_fresh(path)
+        column = self.SORT_COLUMNS[sort_key]
+        direction = "DESC" if reverse else "ASC"
+        rel = self._relpath(path)
+        query = (
+            "SELECT name, parent, size, updated, created FROM entries WHERE kind = ?"
+        )
+        args = ["folder" if folders else "item"]
+        if not recursive:
+            query += " AND parent = ?"
+            args.append(rel)
+        elif rel:
+            query += " AND (parent = ? OR (parent >= ? AND parent < ?))"
+            args += [rel] + list(_subtree_range(rel))
+        if name:
+            query += " AND name = ?"
+            args.append(name)
+        if text:
+            query += " AND instr(lowerName, ?) > 0"
+            args.append(text)
+            if self.has_trigram and len(text) >= 3:
+                query += (
+                    " AND rowid IN (SELECT rowid FROM entries_trigram "
+                    "WHERE entries_trigram MATCH ?)"
+                )
+                args.append('"%s"' % text.replace('"', '""'))
+        if after is not None:
+            query += " AND ({col}, name) {op} (?, ?)".format(
+                col=column, op="<" if reverse else ">"
+            )
+            args += list(after)
+        query += " ORDER BY {col} {dir}, parent {dir}, name {dir}".format(
+            col=column, dir=direction
+        )
+        query += " LIMIT ? OFFSET ?"
+        args += [limit if limit > 0 else -1, offset]
+
+        return self._restat(self._connection().execute(query, args).fetchall(), folders)
+
+    def _restat(self, rows, folders):
+        """
+        Entries of a page, stat'ed from the disk.
+
+        Files written in place don't change the mtime of their directory, so
+        the index only selects and orders the page. Rows that turn out to be
+        stale are fixed, or dropped, for the next queries.
+        """
+        entries, updates, gone = [], [], []
+        for name, parent, size, updated, created in rows:
+            path = os.path.join(self.root_path.as_posix(), parent, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                gone.append((parent, name))
+                continue
+            if stat_module.S_ISDIR(stat.st_mode) != folders:
+                gone.append((parent, name))
+                continue
+            if (stat.st_size, stat.st_mtime, stat.st_ctime) != (size, updated, created):
+                updates.append(
+                    (stat.st_size, stat.st_mtime, stat.st_ctime, parent, name)
+                )
+            entries.append(ListingEntry(name, path, folders, stat))
+        if updates or gone:
+            with self._connection() as conn:
+                conn.executemany(
+                    "UPDATE entries SET size = ?, updated = ?, created = ? "
+                    "WHERE parent = ? AND name = ?",
+                    updates,
+                )
+                conn.executemany(
+                    "DELETE FROM entries WHERE parent = ? AND name = ?", gone
+                )
+        return entries
+
+    def count_children(self, path):
+        """Number of folders and items directly under ``path``."""
+        self.ensure_fresh(path)
+        counts = dict(
+            self._connection().execute(
+                "SELECT kind, COUNT(*) FROM entries WHERE parent = ? GROUP BY kind",
+                (self._relpath(path),),
+            )
+        )
+        return counts.get("folder", 0), counts.get("item", 0)
+
+
+class IndexRegistry(object):
+    """Keeps track of the sidecar indexes stored under ``index_root``."""
+
+    def __init__(self):
+        self.index_root = None
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def configure(self, index_root):
+        with self._lock:
+            if index_root != self.index_root:
+                self._indexes = {}
+            self.index_root = index_root or None
+
+    def db_path(self, root):
+        return os.path.join(self.index_root, "%s.sqlite" % root["_id"])
+
+    def get(self, root, create=False):
+        """
+        Return the index of a mapping.
+
+        :returns: a :class:`MappingIndex` or ``None`` if indexing is disabled, or
+            the mapping was never indexed and ``create`` is False.
+        """
+        if not self.index_root or "fsPath" not in root:
+            return None
+        db_path = self.db_path(root)
+        with self._lock:
+            index = self._indexes.get(db_path)
+            if index is not None and index.root_path == pathlib.Path(root["fsPath"]):
+                return index
+            if not create and not os.path.isfile(db_path):
+                return None
+            os.makedirs(self.index_root, exist_ok=True)
+            index = self._indexes[db_path] = MappingIndex(db_path, root["fsPath"])
+            return index
+
+    def drop(self, root):
+        if not self.index_root:
+            return
+        db_path = self.db_path(root)
+        with self._lock:
+            self._indexes.pop(db_path, None)
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.unlink(db_path + suffix)
+            except FileNotFoundError:
+                pass
+
+    def invalidate_event(self, event):
+        with self._lock:
+            indexes = list(self._indexes.values())
+        for path in event.info:
+            for index in indexes:
+                index.invalidate(path)
+
+
+index_registry = IndexRegistry()
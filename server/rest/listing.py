@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import base64
+import collections
+import heapq
+import json
+import os
+import pathlib
+import stat as stat_module
+import sys
+import threading
+
+
+# Hidden files that uploads are written to, next to their destination
+UPLOAD_PREFIX = ".wtupload-"
+
+# Sort keys that can be computed without building the full document
+SORT_KEYS = {
+    "name": lambda entry: entry.name,
+    "lowerName": lambda entry: entry.name.lower(),
+    "size": lambda entry: entry.stat().st_size,
+    "created": lambda entry: entry.stat().st_ctime,
+    "updated": lambda entry: entry.stat().st_mtime,
+}
+
+
+def cursor_key(sort_key):
+    """Sort key made unique by the entry's name, so it can be resumed from."""
+    key = SORT_KEYS[sort_key]
+
+    def _key(entry):
+        return key(entry), entry.name
+
+    return _key
+
+
+def encode_cursor(sort_key, reverse, last_key):
+    """Opaque token pointing right after ``last_key`` in a sorted listing."""
+    payload = json.dumps([sort_key, reverse, list(last_key)], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_cursor(cursor, sort_key, reverse):
+    """
+    Decode a token created by :func:`encode_cursor`.
+
+    :raises ValueError: if the cursor is malformed or was created for a
+        different sort order.
+    """
+    try:
+        cursor_sort, cursor_reverse, last_key = json.loads(
+            base64.urlsafe_b64decode(cursor.encode()).decode()
+        )
+        last_key = tuple(last_key)
+        assert len(last_key) == 2
+    except Exception:
+        raise ValueError("Invalid cursor.")
+    if cursor_sort != sort_key or cursor_reverse != reverse:
+        raise ValueError("Cursor does not match the requested sort order.")
+    return last_key
+
+
+class ListingEntry(object):
+    """A single child of a scanned directory.
+
+    The type comes from ``readdir`` (``DirEntry.is_dir``), and ``stat`` is only
+    performed once, on first use.
+    """
+
+    __slots__ = ("name", "path", "is_dir", "_stat")
+
+    def __init__(self, name, path, is_dir, stat=None):
+        self.name = name
+        self.path = path
+        self.is_dir = is_dir
+        self._stat = stat
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+
+def scan_directory(path):
+    """
+    List a directory in a single ``os.scandir`` pass.
+
+    :param path: directory to list
+    :type path: pathlib.Path
+    :returns: a tuple of two lists of :class:`ListingEntry`, folders and items.
+        Anything that is neither a directory nor a regular file is skipped, and
+        so are uploads in progress.
+    """
+    folders, items = [], []
+    with os.scandir(path.as_posix()) as it:
+        for entry in it:
+            if entry.name.startswith(UPLOAD_PREFIX):
+                continue
+            try:
+                if entry.is_dir():
+                    folders.append(ListingEntry(entry.name, entry.path, True))
+                elif entry.is_file():
+                    items.append(ListingEntry(entry.name, entry.path, False))
+            except OSError:
+                # Dangling symlink or an entry removed during the scan
+                continue
+    return folders, items
+
+
+def lookup_entry(path, name):
+    """
+    Look up a single child of a directory with one ``stat`` call.
+
+    :returns: a :class:`ListingEntry` or ``None`` if ``name`` doesn't exist
+        or is neither a directory nor a regular file.
+    """
+    if name.startswith(UPLOAD_PREFIX):
+        return None
+    child = (path / name).as_posix()
+    try:
+        stat = os.stat(child)
+    except OSError:
+        return None
+    if stat_module.S_ISDIR(stat.st_mode):
+        return ListingEntry(name, child, True, stat)
+    if stat_module.S_ISREG(stat.st_mode):
+        return ListingEntry(name, child, False, stat)
+    return None
+
+
+def search_tree(path, text, folders=True, scan=scan_directory):
+    """
+    Walk the tree below ``path`` yielding entries whose name contains ``text``.
+
+    :param text: lowercase substring to look for.
+    :param folders: whether to yield matching folders or items.
+    :param scan: function listing a single directory, see :func:`scan_directory`.
+    """
+    visited = set()
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        try:
+            dir_stat = os.stat(current.as_posix())
+            if (dir_stat.st_dev, dir_stat.st_ino) in visited:
+                continue  # symlink loop
+            visited.add((dir_stat.st_dev, dir_stat.st_ino))
+            sub_folders, items = scan(current)
+        except OSError:
+            continue
+        for entry in sub_folders if folders else items:
+            if text in entry.name.lower():
+                yield entry
+        stack.extend(pathlib.Path(entry.path) for entry in sub_folders)
+
+
+def select_page(entries, key, reverse=False, offset=0, limit=0, after=None):
+    """
+    Pick a single page of sorted entries.
+
+    With a positive ``limit`` only ``offset + limit`` keys are kept in a bounded
+    heap instead of sorting the whole listing. The result is the same as
+    ``sorted(entries, key=key, reverse=reverse)[offset:offset + limit]``.
+
+    :param after: if given, only entries whose key sorts after it (in the
+        requested direction) are considered, see :func:`decode_cursor`.
+    """
+    if after is not None:
+        if reverse:
+            entries = (entry for entry in entries if key(entry) < after)
+        else:
+            entries = (entry for entry in entries if key(entry) > after)
+    if limit > 0:
+        select = heapq.nlargest if reverse else heapq.nsmallest
+        return select(offset + limit, entries, key=key)[offset:]
+    return sorted(entries, key=key, reverse=reverse)[offset:]
+
+
+class ListingCache(object):
+    """
+    Per-process LRU cache of directory scans.
+
+    Only names and types are kept, entries are validated against the
+    directory's ``st_mtime_ns`` and ``st_ino`` on every lookup, so a hit costs a
+    single ``stat`` of the directory. Children are still stat'ed on demand.
+    """
+
+    # Rough per-entry overhead of a cached name on top of the string itself
+    ENTRY_OVERHEAD = 16
+
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 ** 2):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._data = collections.OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def configure(self, max_entries=None, max_bytes=None):
+        with self._lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self._evict()
+
+    def scan(self, path):
+        """Same as :func:`scan_directory`, served from the cache when possible."""
+        key = path.as_posix()
+        dir_stat = os.stat(key)
+        stamp = (dir_stat.st_mtime_ns, dir_stat.st_ino)
+        with self._lock:
+            cached = self._data.get(key)
+            if cached is not None and cached[0] == stamp:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return (
+                    [ListingEntry(name, os.path.join(key, name), True) for name in cached[1]],
+                    [ListingEntry(name, os.path.join(key, name), False) for name in cached[2]],
+                )
+            self.misses += 1
+
+        folders, items = scan_directory(path)
+        if self.max_entries > 0:
+            folder_names = tuple(entry.name for entry in folders)
+            item_names = tuple(entry.name for entry in items)
+            size = sum(
+                sys.getsizeof(name) + self.ENTRY_OVERHEAD
+                for name in folder_names + item_names
+            )
+            with self._lock:
+                self._pop(key)
+                if size <= self.max_bytes:
+                    self._data[key] = (stamp, folder_names, item_names, size)
+                    self._bytes += size
+                    self._evict()
+        return folders, items
+
+    def invalidate(self, path):
+        """Drop ``path``, anything below it and its parent directory."""
+        key = path.as_posix()
+        prefix = key.rstrip("/") + "/"
+        with self._lock:
+            self._pop(path.parent.as_posix())
+            for cached_key in [k for k in self._data if k == key or k.startswith(prefix)]:
+                self._pop(cached_key)
+
+    def invalidate_event(self, event):
+        for path in event.info:
+            self.invalidate(path)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "maxEntries": self.max_entries,
+                "maxBytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _pop(self, key):
+        cached = self._data.pop(key, None)
+        if cached is not None:
+            self._bytes -= cached[3]
+
+    def _evict(self):
+        while self._data and (
+            len(self._data) > self.max_entries or self._bytes > self.max_bytes
+        ):
+            _, cached = self._data.popitem(last=False)
+            self._bytes -= cached[3]
+            self.evictions += 1
+
+
+listing_cache = ListingCache()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from girder import logger
+from girder.models.folder import Folder
+
+
+class MappingRegistry(object):
+    """
+    In-memory map of mapping folder ids to the paths they expose.
+
+    It lets request handlers tell a mapping root from a regular Girder folder
+    without loading the folder. The registry is filled from the database on
+    first use and kept current by the folder model events of this process.
+    Mappings changed by other processes are picked up by a reload in the
+    background, started by the first lookup after ``resync_interval`` seconds.
+    """
+
+    def __init__(self, resync_interval=60):
+        self.resync_interval = resync_interval
+        self._lock = threading.Lock()
+        self._paths = {}
+        self._loaded_at = None
+        self._reloading = False
+        # Changes made by this process while a reload reads the database
+        self._changes = None
+
+    def reload(self):
+        with self._lock:
+            self._changes = {}
+        try:
+            paths = {
+                str(folder["_id"]): folder["fsPath"]
+                for folder in Folder().find(
+                    {"fsPath": {"$exists": True}}, fields=["fsPath"]
+                )
+                if folder.get("fsPath")
+            }
+        finally:
+            with self._lock:
+                changes, self._changes = self._changes, None
+        for folder_id, fs_path in changes.items():
+            if fs_path:
+                paths[folder_id] = fs_path
+            else:
+                paths.pop(folder_id, None)
+        with self._lock:
+            self._paths = paths
+            self._loaded_at = time.time()
+
+    def get(self, folder_id):
+        """:returns: the ``fsPath`` of a mapping folder or ``None``."""
+        if self._loaded_at is None:
+            self.reload()
+        elif time.time() - self._loaded_at > self.resync_interval:
+            self._reload_in_background()
+        return self._paths.get(str(folder_id))
+
+    def _reload_in_background(self):
+        with self._lock:
+            if self._reloading:
+                return
+            self._reloading = True
+
+        def run():
+            try:
+                self.reload()
+            except Exception:
+                logger.exception("Reloading virtual_resources mappings failed")
+            finally:
+                with self._lock:
+                    self._reloading = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def update(self, folder):
+        with self._lock:
+            if folder.get("fsPath"):
+                self._paths[str(folder["_id"])] = folder["fsPath"]
+            else:
+                self._paths.pop(str(folder["_id"]), None)
+            if self._changes is not None:
+                self._changes[str(folder["_id"])] = folder.get("fsPath")
+
+    def remove(self, folder):
+        with self._lock:
+            self._paths.pop(str(folder["_id"]), None)
+            if self._changes is not None:
+                self._changes[str(folder["_id"])] = None
+
+    def save_event(self, event):
+        self.update(event.info)
+
+    def remove_event(self, event):
+        self.remove(event.info)
+
+
+mapping_registry = MappingRegistry()
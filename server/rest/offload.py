@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from urllib.parse import quote
+
+
+SENDFILE_HEADERS = ("X-Accel-Redirect", "X-Sendfile")
+
+
+class SendfileOffload(object):
+    """
+    Hands file transfers over to the front-end web server.
+
+    Instead of streaming the content, the response only carries a header
+    naming the file: ``X-Accel-Redirect`` for nginx, where the file path is
+    appended to ``prefix`` (an ``internal`` location aliased to ``/``), or
+    ``X-Sendfile`` for Apache/lighttpd. The proxy then serves the file with
+    ``sendfile(2)`` and handles ``Range`` itself.
+    """
+
+    def __init__(self):
+        self.header = None
+        self.prefix = ""
+
+    @property
+    def enabled(self):
+        return self.header is not None
+
+    def configure(self, header, prefix=""):
+        self.header = header or None
+        self.prefix = (prefix or "").rstrip("/")
+
+    def headers(self, path):
+        """
+        Response headers passing ``path`` on to the proxy.
+
+        :returns: a dict, or ``None`` if the path can't be sent in a header.
+        """
+        path = path.as_posix()
+        try:
+            if self.header == "X-Accel-Redirect":
+                return {self.header: quote(self.prefix + path)}
+            path.encode("latin-1")
+        except UnicodeEncodeError:
+            return None
+        return {self.header: path}
+
+
+sendfile_offload = SendfileOffload()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import copy
+import threading
+import time
+
+from girder.models.folder import Folder
+
+
+class RootCache(object):
+    """
+    Short-lived cache of mapping root folders and of users' access to them.
+
+    Saving or removing a folder in this process drops its entries right away,
+    changes made by other processes are picked up after ``ttl`` seconds.
+    """
+
+    def __init__(self, ttl=30, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._roots = {}
+        self._levels = {}
+
+    def load(self, root_id, level, user):
+        """Same as ``Folder().load(root_id, level=level, user=user, exc=True)``."""
+        root_id = str(root_id)
+        user_key = (root_id, str(user["_id"]) if user else None)
+        now = time.time()
+        with self._lock:
+            cached = self._roots.get(root_id)
+            access = self._levels.get(user_key)
+        if cached is None or cached[1] < now:
+            root = Folder().load(root_id, force=True, exc=True)
+            with self._lock:
+                self._roots[root_id] = (root, now + self.ttl)
+        else:
+            root = cached[0]
+        if access is None or access[1] < now:
+            access = (Folder().getAccessLevel(root, user), now + self.ttl)
+            with self._lock:
+                if len(self._levels) >= self.max_entries:
+                    self._levels = {
+                        key: value for key, value in self._levels.items()
+                        if value[1] >= now
+                    }
+                self._levels[user_key] = access
+        if access[0] < level:
+            # Raises the same exception as an uncached load would
+            Folder().requireAccess(root, user, level)
+        # Callers update the root document in place
+        return copy.copy(root)
+
+    def invalidate(self, root_id):
+        root_id = str(root_id)
+        with self._lock:
+            self._roots.pop(root_id, None)
+            for key in [k for k in self._levels if k[0] == root_id]:
+                del self._levels[key]
+
+    def invalidate_event(self, event):
+        self.invalidate(event.info["_id"])
+
+    def clear(self):
+        with self._lock:
+            self._roots.clear()
+            self._levels.clear()
+
+
+root_cache = RootCache()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import collections
+import concurrent.futures
+import os
+import pathlib
+import threading
+import time
+
+from .listing import scan_directory
+
+
+FolderSize = collections.namedtuple("FolderSize", ["size", "nFiles"])
+
+
+class FolderSizes(object):
+    """
+    Recursive size and file count of directories, computed in the background.
+
+    Lookups never walk the tree. An unknown, stale or expired directory is
+    queued for a background walk and the caller gets whatever is known. A walk
+    stores the totals of every directory it visits and reuses fresh totals of
+    subdirectories, so after a change only the affected branch is read again.
+    """
+
+    def __init__(self, ttl=300, max_entries=100000, workers=1):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._data = collections.OrderedDict()
+        self._pending = set()
+        self._executor = None
+        self.walks = 0
+        # Per directory, when a total shown in its listing last changed
+        self._stamps = collections.OrderedDict()
+        self._counter = 0
+        # Highest stamp that was dropped from _stamps
+        self._floor = 0
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def configure(self, ttl=None):
+        with self._lock:
+            if ttl is not None:
+                self.ttl = ttl
+            if not self.enabled:
+                self._data.clear()
+                self._stamps.clear()
+                self._counter += 1
+                self._floor = self._counter
+
+    def get(self, path):
+        """
+        Recursive size of ``path``.
+
+        :returns: a :class:`FolderSize` or ``None`` if it was not computed yet.
+        """
+        if not self.enabled:
+            return None
+        key = path.as_posix() if isinstance(path, pathlib.Path) else path
+        with self._lock:
+            cached = self._data.get(key)
+            if cached is not None:
+                self._data.move_to_end(key)
+        if cached is None or not self._is_fresh(cached):
+            self.schedule(key)
+        return cached[0] if cached is not None else None
+
+    def version(self, path):
+        """
+        Opaque value that changes whenever the total of ``path``, or of one of
+        its direct subdirectories, changes. Walks that find the same totals
+        again leave it alone.
+        """
+        key = path.as_posix() if isinstance(path, pathlib.Path) else path
+        with self._lock:
+            return self._stamps.get(key, self._floor)
+
+    def size_of(self, entry):
+        """Recursive size of a folder listing entry, falling back to its stat."""
+        known = self.get(entry.path)
+        return known.size if known is not None else entry.stat().st_size
+
+    def schedule(self, key):
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="folder_sizes"
+                )
+        self._executor.submit(self._refresh, key)
+
+    def invalidate(self, path):
+        """Drop ``path`` and everything below it, and mark its parents stale."""
+        key = path.as_posix()
+        prefix = key.rstrip("/") + "/"
+        with self._lock:
+            for cached_key in [k for k in self._data if k == key or k.startswith(prefix)]:
+                del self._data[cached_key]
+                self._changed(cached_key)
+            for parent in path.parents:
+                cached = self._data.get(parent.as_posix())
+                if cached is not None:
+                    self._data[parent.as_posix()] = (cached[0], cached[1], True)
+
+    def invalidate_event(self, event):
+        for path in event.info:
+            self.invalidate(path)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "pending": len(self._pending),
+                "ttl": self.ttl,
+                "walks": self.walks,
+            }
+
+    def _is_fresh(self, cached):
+        return not cached[2] and time.time() - cached[1] < self.ttl
+
+    def _refresh(self, key):
+        with self._lock:
+            self.walks += 1
+        try:
+            self._walk(pathlib.Path(key), set())
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def _walk(self, path, visited):
+        dir_stat = os.stat(path.as_posix())
+        if (dir_stat.st_dev, dir_stat.st_ino) in visited:
+            return FolderSize(0, 0)  # symlink loop
+        visited.add((dir_stat.st_dev, dir_stat.st_ino))
+
+        size = n_files = 0
+        folders, items = scan_directory(path)
+        for entry in items:
+            try:
+                size += entry.stat().st_size
+                n_files += 1
+            except OSError:
+                continue
+        for entry in folders:
+            with self._lock:
+                cached = self._data.get(entry.path)
+            if cached is not None and self._is_fresh(cached):
+                total = cached[0]
+            else:
+                try:
+                    total = self._walk(pathlib.Path(entry.path), visited)
+                except OSError:
+                    continue
+            size += total.size
+            n_files += total.nFiles
+
+        total = FolderSize(size, n_files)
+        key = path.as_posix()
+        with self._lock:
+            cached = self._data.get(key)
+            if cached is None or cached[0] != total:
+                self._changed(key)
+            self._data[key] = (total, time.time(), False)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._changed(self._data.popitem(last=False)[0])
+        return total
+
+    def _changed(self, key):
+        """Stamp ``key`` and its parent, whose listing shows its total."""
+        self._counter += 1
+        for stamped in (key, os.path.dirname(key)):
+            self._stamps[stamped] = self._counter
+            self._stamps.move_to_end(stamped)
+        while len(self._stamps) > self.max_entries:
+            self._floor = max(self._floor, self._stamps.popitem(last=False)[1])
+
+
+folder_sizes = FolderSizes()
@@ -2,29 +2,150 @@
 # -*- coding: utf-8 -*-
 import cherrypy
 import errno
+import io
 import os
 import pathlib
 import shutil
 import stat
+import tempfile
+import uuid
 
 from girder import events
 from girder.api import access
 from girder.api.rest import setResponseHeader
 from girder.constants import AccessType, TokenScope
-from girder.exceptions import GirderException, AccessException, RestException
+from girder.exceptions import (
+    GirderException,
+    AccessException,
+    RestException,
+    ValidationException,
+)
 from girder.models.assetstore import Assetstore
 from girder.models.file import File
 from girder.models.folder import Folder
 from girder.models.upload import Upload
-from girder.utility import RequestBodyStream, assetstore_utilities
+from girder.utility import RequestBodyStream, assetstore_utilities, toBool
+from pymongo import ReturnDocument
 
-from . import VirtualObject, validate_event, bail_if_exists
+from . import VirtualObject, validate_event, bail_if_exists, notify_changed
+from .checksums import checksums
+from .conditional import check_not_modified, file_etag, range_applies
+from .listing import UPLOAD_PREFIX
+from .offload import sendfile_offload
 
 
 BUF_SIZE = 65536
+DOWNLOAD_BUF_SIZE = 1024 ** 2
+MAX_RANGES = 256
+# Seconds a request waits for checksums before leaving them to the background
+CHECKSUM_WAIT = 2
+UPLOAD_BUF_SIZE = 1024 ** 2
 DEFAULT_PERMS = stat.S_IRUSR | stat.S_IWUSR
 
 
+def _copy_range(f, offset, end_byte, buf_size):
+    if end_byte > offset and hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(f.fileno(), offset, end_byte - offset, os.POSIX_FADV_SEQUENTIAL)
+    f.seek(offset)
+    remaining = end_byte - offset
+    while remaining > 0:
+        data = f.read(min(buf_size, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+
+
+def read_range(path, offset, end_byte, buf_size=DOWNLOAD_BUF_SIZE):
+    """
+    Yield bytes ``[offset, end_byte)`` of a file.
+
+    The file is read unbuffered, so each block is copied once, straight into
+    the ``bytes`` object that is yielded.
+    """
+    with open(path.as_posix(), "rb", buffering=0) as f:
+        yield from _copy_range(f, offset, end_byte, buf_size)
+
+
+def merge_ranges(ranges):
+    """Sorted, disjoint ``[start, end)`` ranges covering the same bytes as ``ranges``."""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def write_at(path, offset, chunk, limit):
+    """
+    Copy ``chunk`` into the file at ``offset`` with positioned writes, so
+    that chunks of the same file can be written concurrently.
+
+    :raises ValidationException: if the chunk goes past ``limit``.
+    """
+    position = offset
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        while True:
+            data = chunk.read(UPLOAD_BUF_SIZE)
+            if not data:
+                break
+            if position + len(data) > limit:
+                raise ValidationException("Received too many bytes.")
+            view = memoryview(data)
+            while view:
+                written = os.pwrite(fd, view, position)
+                position += written
+                view = view[written:]
+    finally:
+        os.close(fd)
+    return position - offset
+
+
+class ByteRanges(object):
+    """
+    A ``multipart/byteranges`` response body (RFC 7233, appendix A).
+
+    Part headers are built upfront so the ``Content-Length`` is known before
+    anything is read, the ranges themselves are streamed from the file.
+    """
+
+    def __init__(self, ranges, size, content_type="application/octet-stream"):
+        self.boundary = uuid.uuid4().hex
+        self.parts = [
+            (
+                start,
+                stop,
+                (
+                    "--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n"
+                    % (self.boundary, content_type, start, stop - 1, size)
+                ).encode(),
+            )
+            for start, stop in ranges
+        ]
+        self.trailer = ("--%s--\r\n" % self.boundary).encode()
+
+    @property
+    def content_type(self):
+        return "multipart/byteranges; boundary=%s" % self.boundary
+
+    @property
+    def content_length(self):
+        return len(self.trailer) + sum(
+            len(header) + stop - start + 2 for start, stop, header in self.parts
+        )
+
+    def stream(self, path, buf_size=DOWNLOAD_BUF_SIZE):
+        with open(path.as_posix(), "rb", buffering=0) as f:
+            for start, stop, header in self.parts:
+                yield header
+                yield from _copy_range(f, start, stop, buf_size)
+                yield b"\r\n"
+        yield self.trailer
+
+
 class VirtualFile(VirtualObject):
     def __init__(self):
         super(VirtualFile, self).__init__()
@@ -43,7 +164,7 @@ class VirtualFile(VirtualObject):
         # PUT /file/:id/move
         events.bind("rest.post.file/chunk.before", name, self.read_chunk)
         # POST /file/completion
-        # GET /file/offset
+        events.bind("rest.get.file/offset.before", name, self.request_offset)
         # DELETE /file/upload/:id
 
     @access.user(scope=TokenScope.DATA_WRITE)
@@ -63,6 +184,7 @@ class VirtualFile(VirtualObject):
             )
         except Exception:
             raise
+        notify_changed(file_path)
 
         parent = Folder().filter(self.vFolder(path, root), user=user)
         size = int(params["size"])
@@ -81,6 +203,9 @@ class VirtualFile(VirtualObject):
         )
 
         if upload["size"] > 0:
+            upload = self._stage_upload(upload, path)
+            if toBool(params.get("parallel", False)):
+                upload = self._init_parallel_upload(upload)
             if chunk:
                 fobj = self._handle_chunk(upload, chunk, filter=True, user=user)
                 event.preventDefault().addResponse(fobj)
@@ -94,9 +219,12 @@ class VirtualFile(VirtualObject):
     @access.public(scope=TokenScope.DATA_READ)
     @validate_event(level=AccessType.READ)
     def get_file_info(self, event, path, root, user=None):
-        event.preventDefault().addResponse(
-            File().filter(self.vFile(path, root), user=user)
-        )
+        self.is_file(path, root["_id"])
+        file_stat = path.stat()
+        doc = File().filter(self.vFile(path, root, stat=file_stat), user=user)
+        if toBool(event.info["params"].get("checksums", False)):
+            doc.update(checksums.get(path, file_stat, wait=CHECKSUM_WAIT))
+        event.preventDefault().addResponse(doc)
 
     @access.user(scope=TokenScope.DATA_WRITE)
     @validate_event(level=AccessType.WRITE)
@@ -105,6 +233,7 @@ class VirtualFile(VirtualObject):
         new_path = path.with_name(event.info["params"]["name"])
         bail_if_exists(new_path)
         path.rename(new_path)
+        notify_changed(path, new_path)
         event.preventDefault().addResponse(
             File().filter(self.vFile(new_path, root), user=user)
         )
@@ -114,59 +243,95 @@ class VirtualFile(VirtualObject):
     def remove_file(self, event, path, root, user=None):
         self.is_file(path, root["_id"])
         path.unlink()
+        notify_changed(path)
         event.preventDefault().addResponse({"message": "Deleted file %s." % path.name})
 
     @access.cookie
     @access.public(scope=TokenScope.DATA_READ)
     @validate_event(level=AccessType.READ)
     def file_download(self, event, path, root, user=None):
-        fobj = self.vFile(path, root)
+        self.is_file(path, root["_id"])
+        file_stat = path.stat()
+        fobj = self.vFile(path, root, stat=file_stat)
+        params = event.info["params"]
+        etag = file_etag(file_stat)
+        check_not_modified(etag, file_stat.st_mtime)
 
-        rangeHeader = cherrypy.lib.httputil.get_ranges(
-            cherrypy.request.headers.get("Range"), fobj.get("size", 0)
+        setResponseHeader("Accept-Ranges", "bytes")
+        setResponseHeader("Content-Type", "application/octet-stream")
+        disp = params.get("contentDisposition", "attachment")
+        setResponseHeader(
+            "Content-Disposition", '{}; filename="{}"'.format(disp, fobj["name"])
         )
-        # The HTTP Range header takes precedence over query params
-        if rangeHeader and len(rangeHeader):
-            # Currently we only support a single range.
+
+        # The proxy can serve whole files and Range requests, but knows nothing
+        # about the offset/endByte params.
+        if sendfile_offload.enabled and not {"offset", "endByte"} & set(params):
+            headers = sendfile_offload.headers(path)
+            if headers:
+                for key, value in headers.items():
+                    setResponseHeader(key, value)
+                event.preventDefault().addResponse(lambda: iter(()))
+                return
+
+        rangeHeader = None
+        if range_applies(etag, file_stat.st_mtime):
+            rangeHeader = cherrypy.lib.httputil.get_ranges(
+                cherrypy.request.headers.get("Range"), fobj.get("size", 0)
+            )
+        if rangeHeader and 1 < len(rangeHeader) <= MAX_RANGES:
+            body = ByteRanges(rangeHeader, fobj["size"])
+            cherrypy.response.status = 206
+            setResponseHeader("Content-Type", body.content_type)
+            setResponseHeader("Content-Length", body.content_length)
+
+            def stream():
+                return body.stream(path)
+
+            event.preventDefault().addResponse(stream)
+            return
+
+        # The HTTP Range header takes precedence over query params. Requests
+        # with too many ranges get the whole file (RFC 7233, section 3.1).
+        if rangeHeader and len(rangeHeader) == 1:
             offset, endByte = rangeHeader[0]
+        elif rangeHeader:
+            offset, endByte = 0, fobj["size"]
         else:
-            endByte = min(
-                int(event.info["params"].get("endByte", fobj["size"])), fobj["size"]
-            )
-            offset = int(event.info["params"].get("offset", "0"))
+            endByte = min(int(params.get("endByte", fobj["size"])), fobj["size"])
+            offset = int(params.get("offset", "0"))
 
-        setResponseHeader("Accept-Ranges", "bytes")
-        setResponseHeader("Content-Type", "application/octet-stream")
         setResponseHeader("Content-Length", max(endByte - offset, 0))
         if (offset or endByte < fobj["size"]) and fobj["size"]:
             setResponseHeader(
                 "Content-Range", "bytes %d-%d/%d" % (offset, endByte - 1, fobj["size"])
             )
-        disp = event.info["params"].get("contentDisposition", "attachment")
-        setResponseHeader(
-            "Content-Disposition", '{}; filename="{}"'.format(disp, fobj["name"])
-        )
 
         def stream():
-            bytesRead = offset
-            with path.open(mode="rb") as f:
-                if offset > 0:
-                    f.seek(offset)
-
-                while True:
-                    readLen = min(BUF_SIZE, endByte - bytesRead)
-                    if readLen <= 0:
-                        break
-
-                    data = f.read(readLen)
-                    bytesRead += readLen
-
-                    # if not data:
-                    #    break
-                    yield data
+            return read_range(path, offset, endByte)
 
         event.preventDefault().addResponse(stream)
 
+    @staticmethod
+    def _stage_upload(upload, path):
+        """
+        Write the upload to a hidden file in its destination directory instead
+        of the assetstore's temporary directory, so that it is stored once and
+        finalized by a rename.
+        """
+        try:
+            fd, temp_path = tempfile.mkstemp(prefix=UPLOAD_PREFIX, dir=path.as_posix())
+        except OSError:
+            return upload  # keep the assetstore's temporary file
+        os.close(fd)
+        if upload.get("tempFile"):
+            try:
+                os.unlink(upload["tempFile"])
+            except OSError:
+                pass
+        upload["tempFile"] = temp_path
+        return Upload().save(upload)
+
     def _finalize_upload(self, upload, assetstore=None):
         if assetstore is None:
             assetstore = Assetstore().load(upload["assetstoreId"])
@@ -177,11 +342,87 @@ class VirtualFile(VirtualObject):
             root = Folder().load(upload["parentId"], force=True)
             path = pathlib.Path(root["fsPath"])
         abspath = path / upload["name"]
-        shutil.move(upload["tempFile"], abspath.as_posix())
-        abspath.chmod(assetstore.get("perms", DEFAULT_PERMS))
+        os.chmod(upload["tempFile"], assetstore.get("perms", DEFAULT_PERMS))
+        try:
+            os.rename(upload["tempFile"], abspath.as_posix())
+        except OSError as exc:
+            # Uploads staged in the assetstore's temporary directory
+            if exc.errno != errno.EXDEV:
+                raise
+            shutil.move(upload["tempFile"], abspath.as_posix())
+        notify_changed(abspath)
         return self.vFile(abspath, root)
 
+    @staticmethod
+    def _init_parallel_upload(upload):
+        """
+        Switch an upload to parallel mode: chunks may be sent concurrently and
+        in any order, and are written in place into a preallocated file.
+        """
+        fd = os.open(upload["tempFile"], os.O_WRONLY)
+        try:
+            os.posix_fallocate(fd, 0, upload["size"])
+        except (AttributeError, OSError):
+            os.ftruncate(fd, upload["size"])  # sparse, if it can't be preallocated
+        finally:
+            os.close(fd)
+        upload.update(parallel=True, receivedRanges=[], received=0)
+        return Upload().save(upload)
+
+    def _handle_parallel_chunk(self, upload, chunk, offset):
+        """
+        Write a chunk of a parallel upload and record its range.
+
+        Concurrent requests only ever touch the upload document with atomic
+        updates. The request that completes the coverage of the file claims
+        the upload and finalizes it, the others get the upload back. Chunks
+        retried once the upload is claimed get a 409.
+        """
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf8")
+        if isinstance(chunk, bytes):
+            chunk = RequestBodyStream(io.BytesIO(chunk), size=len(chunk))
+        if offset < 0 or offset + max(chunk.getSize() or 0, 0) > upload["size"]:
+            raise ValidationException("Received too many bytes.")
+        finalizing = RestException(
+            "Upload %s is complete and being finalized." % upload["_id"], code=409
+        )
+        if upload.get("finalizing"):
+            raise finalizing
+        try:
+            end = offset + write_at(upload["tempFile"], offset, chunk, upload["size"])
+        except FileNotFoundError:
+            raise finalizing  # moved into place since the upload was loaded
+
+        collection = Upload().collection
+        upload = collection.find_one_and_update(
+            {"_id": upload["_id"]},
+            {"$push": {"receivedRanges": [offset, end]}},
+            return_document=ReturnDocument.AFTER,
+        )
+        ranges = merge_ranges(upload["receivedRanges"])
+        received = sum(end - start for start, end in ranges)
+        collection.update_one({"_id": upload["_id"]}, {"$max": {"received": received}})
+        upload.update(receivedRanges=ranges, received=received)
+        if received < upload["size"]:
+            return upload
+
+        claimed = collection.find_one_and_update(
+            {"_id": upload["_id"], "finalizing": {"$exists": False}},
+            {"$set": {"finalizing": True}},
+        )
+        if claimed is None:
+            return upload  # finalized by another request
+        try:
+            return self._finalize_upload(upload)
+        except Exception:
+            # Let a retried chunk finalize it again
+            collection.update_one({"_id": upload["_id"]}, {"$unset": {"finalizing": ""}})
+            raise
+
     def _handle_chunk(self, upload, chunk, filter=False, user=None):
+        if upload.get("parallel"):
+            return self._handle_parallel_chunk(upload, chunk, 0)
         assetstore = Assetstore().load(upload["assetstoreId"])
         adapter = assetstore_utilities.getAssetstoreAdapter(assetstore)
 
@@ -218,6 +459,11 @@ class VirtualFile(VirtualObject):
         if upload["userId"] != user["_id"]:
             raise AccessException("You did not initiate this upload.")
 
+        if upload.get("parallel"):
+            fobj = self._handle_parallel_chunk(upload, chunk, offset)
+            event.preventDefault().addResponse(fobj)
+            return
+
         if upload["received"] != offset:
             raise RestException(
                 "Server has received %s bytes, but client sent offset %s."
@@ -231,3 +477,20 @@ class VirtualFile(VirtualObject):
             if exc.errno == errno.EACCES:
                 raise Exception("Failed to store upload.")
             raise
+
+    @access.user(scope=TokenScope.DATA_WRITE)
+    @validate_event(level=AccessType.WRITE)
+    def request_offset(self, event, path, root, user=None):
+        """
+        Resume point of a parallel upload: the end of its first contiguous
+        range, along with every range received so far. Sequential uploads are
+        left to Girder.
+        """
+        upload = Upload().load(event.info["params"]["uploadId"])
+        if not upload.get("parallel"):
+            return
+        if upload["userId"] != user["_id"]:
+            raise AccessException("You did not initiate this upload.")
+        ranges = merge_ranges(upload.get("receivedRanges", []))
+        offset = ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+        event.preventDefault().addResponse({"offset": offset, "receivedRanges": ranges})
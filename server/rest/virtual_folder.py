@@ -1,35 +1,75 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from operator import itemgetter
-import os
+import cherrypy
 import pathlib
-import pymongo
 import shutil
+import threading
 
 from girder import events
 from girder.api import access
+from girder.api.describe import Description, autoDescribeRoute
 from girder.api.rest import setResponseHeader, setContentDisposition
 from girder.constants import TokenScope, AccessType
-from girder.exceptions import GirderException, ValidationException
+from girder.exceptions import GirderException, RestException, ValidationException
 from girder.models.folder import Folder
-from girder.utility import ziputil
+from girder.models.item import Item
 
-from . import VirtualObject, validate_event, ensure_unique_path, bail_if_exists
+from . import (
+    VirtualObject,
+    validate_event,
+    ensure_unique_path,
+    bail_if_exists,
+    notify_changed,
+    filter_children,
+    load_root,
+)
+from .archive import (
+    ARCHIVE_CONTENT_TYPES,
+    ARCHIVE_FORMATS,
+    COMPRESSION_MODES,
+    ReadAhead,
+    StoredZip,
+    TarStream,
+    ZipStream,
+    tar_files,
+    walk_files,
+    walk_tree,
+)
+from .archive_cache import archive_cache
+from .conditional import check_not_modified, range_applies
+from .index import index_registry
+from .offload import sendfile_offload
+from .sizes import folder_sizes
+from .virtual_file import read_range
 
 
-def file_stream(path, buf_size=65536):
-    bytes_read = 0
-    end_byte = path.stat().st_size
-    with path.open(mode="rb") as f:
-        while True:
-            read_len = min(buf_size, end_byte - bytes_read)
-            if read_len <= 0:
-                break
-            data = f.read(read_len)
-            bytes_read += read_len
-            # if not data:
-            #    break
-            yield data
+def zip_params(params):
+    """Compression options of a folder download, see :class:`.archive.ZipStream`."""
+    compression = params.get("compression") or "auto"
+    if compression not in COMPRESSION_MODES:
+        raise ValidationException(
+            "Compression must be one of: %s." % ", ".join(COMPRESSION_MODES),
+            "compression",
+        )
+    try:
+        level = int(params.get("compressionLevel", 6))
+        if not 1 <= level <= 9:
+            raise ValueError
+    except (TypeError, ValueError):
+        raise ValidationException(
+            "Compression level must be an integer between 1 and 9.", "compressionLevel"
+        )
+    return dict(compression=compression, level=level)
+
+
+def archive_format(params):
+    """Format of a folder download, zip unless a tar format is requested."""
+    archive = params.get("format") or "zip"
+    if archive not in ARCHIVE_FORMATS:
+        raise ValidationException(
+            "Format must be one of: %s." % ", ".join(ARCHIVE_FORMATS), "format"
+        )
+    return archive
 
 
 class VirtualFolder(VirtualObject):
@@ -55,31 +95,108 @@ class VirtualFolder(VirtualObject):
         events.bind("rest.get.folder/:id/rootpath.before", name, self.folder_root_path)
         events.bind("rest.post.folder/recursive.before", name, self.create_folder_recursive)
 
+        self.route("GET", (":id", "children"), self.get_children)
+        self.route("POST", (":id", "index"), self.build_index)
+        self.route("DELETE", (":id", "index"), self.drop_index)
+
+    @access.public(scope=TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description("List child folders and items of a virtual folder at once.")
+        .notes("Both lists, and their counts, come from a single directory scan.")
+        .param("id", "The ID of a virtual folder or a mapping.", paramType="path")
+        .param("limit", "Result set size limit for each list.", required=False,
+               dataType="integer", default=50)
+        .param("offset", "Offset into each result set.", required=False,
+               dataType="integer", default=0)
+        .param("sort", "Field to sort the result sets by.", required=False,
+               default="lowerName")
+        .param("sortdir", "1 for ascending, -1 for descending.", required=False,
+               dataType="integer", default=1)
+        .param("folderCursor", "Cursor returned for the previous page of folders.",
+               required=False)
+        .param("itemCursor", "Cursor returned for the previous page of items.",
+               required=False)
+        .errorResponse("ID was invalid.")
+        .errorResponse("Read access was denied for the folder.", 403)
+    )
+    def get_children(self, id, limit, offset, sort, sortdir, folderCursor, itemCursor):
+        path, root_id = self.path_from_id(id)
+        user = self.getCurrentUser()
+        root = load_root(root_id, AccessType.READ, user) if path else None
+        if root is None:
+            raise ValidationException("Folder {} is not a mapping.".format(id), "id")
+        self.is_dir(path, root["_id"])
+
+        params = dict(limit=limit, offset=offset, sort=sort, sortdir=sortdir)
+        scan = self.scan_children(path, root)
+        n_folders, n_items = self.count_children(path, root, scan=scan)
+
+        def make_folder(entry):
+            return self.vFolder(pathlib.Path(entry.path), root, stat=entry.stat())
+
+        def make_item(entry):
+            return self.vItem(pathlib.Path(entry.path), root, stat=entry.stat())
+
+        folders, folder_cursor = self.list_children(
+            path, root, dict(params, cursor=folderCursor), make_folder, scan=scan
+        )
+        items, item_cursor = self.list_children(
+            path, root, dict(params, cursor=itemCursor), make_item, folders=False,
+            scan=scan,
+        )
+        return {
+            "folders": filter_children(Folder(), folders, user),
+            "items": filter_children(Item(), items, user),
+            "nFolders": n_folders,
+            "nItems": n_items,
+            "folderCursor": folder_cursor,
+            "itemCursor": item_cursor,
+        }
+
+    @staticmethod
+    def _require_mapping(folder):
+        if "fsPath" not in folder:
+            raise ValidationException("Folder {} is not a mapping.".format(folder["_id"]))
+
+    @access.admin
+    @autoDescribeRoute(
+        Description("Build or rebuild the sidecar index of a mapping.")
+        .notes("Indexing runs in the background. Requires the index root setting.")
+        .modelParam("id", model=Folder, level=AccessType.ADMIN)
+        .errorResponse("Admin access was denied.", 403)
+    )
+    def build_index(self, folder):
+        self._require_mapping(folder)
+        index = index_registry.get(folder, create=True)
+        if index is None:
+            raise ValidationException("Mapping indexes are disabled.")
+        threading.Thread(target=index.build, daemon=True).start()
+        return {"message": "Indexing of %s started." % folder["fsPath"]}
+
+    @access.admin
+    @autoDescribeRoute(
+        Description("Remove the sidecar index of a mapping.")
+        .modelParam("id", model=Folder, level=AccessType.ADMIN)
+        .errorResponse("Admin access was denied.", 403)
+    )
+    def drop_index(self, folder):
+        self._require_mapping(folder)
+        index_registry.drop(folder)
+        return {"message": "Removed index of %s." % folder["fsPath"]}
+
     @access.public(scope=TokenScope.DATA_READ)
     @validate_event(level=AccessType.READ)
     def get_child_folders(self, event, path, root, user=None):
         params = event.info["params"]
-        name = params.get("name")
-        offset = int(params.get("offset", 0))
-        limit = int(params.get("limit", 50))
-        sort_key = params.get("sort", "lowerName")
-        reverse = int(params.get("sortdir", pymongo.ASCENDING)) == pymongo.DESCENDING
-
-        # TODO: implement "text"
-        if name:
-            if (path / name).is_dir():
-                folders = [self.vFolder(path / name, root)]
-            else:
-                folders = []
-        else:
-            folders = [self.vFolder(obj, root) for obj in path.iterdir() if obj.is_dir()]
+        self.check_listing(path, root, user, params, folder_sizes.version(path))
 
-        folders = sorted(folders, key=itemgetter(sort_key), reverse=reverse)
-        upper_bound = limit + offset if limit > 0 else None
-        response = [
-            Folder().filter(folder, user=user) for folder in folders[offset:upper_bound]
-        ]
-        event.preventDefault().addResponse(response)
+        def make_doc(entry):
+            return self.vFolder(pathlib.Path(entry.path), root, stat=entry.stat())
+
+        folders, next_cursor = self.list_children(path, root, params, make_doc)
+        if next_cursor:
+            setResponseHeader("Girder-Next-Cursor", next_cursor)
+        event.preventDefault().addResponse(filter_children(Folder(), folders, user))
 
     @access.user(scope=TokenScope.DATA_WRITE)
     @validate_event(level=AccessType.WRITE)
@@ -92,6 +209,7 @@ class VirtualFolder(VirtualObject):
             raise ValidationException(
                 "A folder with that name already exists here.", "name"
             )
+        notify_changed(new_path)
         event.preventDefault().addResponse(
             Folder().filter(self.vFolder(new_path, root), user=user)
         )
@@ -127,6 +245,7 @@ class VirtualFolder(VirtualObject):
             shutil.move(
                 path.as_posix(), new_path.as_posix(), copy_function=shutil.copytree
             )
+        notify_changed(path, new_path)
 
         event.preventDefault().addResponse(
             Folder().filter(self.vFolder(new_path, root), user=user)
@@ -137,6 +256,7 @@ class VirtualFolder(VirtualObject):
     def remove_folder(self, event, path, root, user=None):
         self.is_dir(path, root["_id"])
         shutil.rmtree(path.as_posix())
+        notify_changed(path)
         event.preventDefault().addResponse(
             {"message": "Deleted folder %s." % path.name}
         )
@@ -150,6 +270,7 @@ class VirtualFolder(VirtualObject):
                 sub_path.unlink()
             elif sub_path.is_dir():
                 shutil.rmtree(sub_path.as_posix())
+        notify_changed(path)
         event.preventDefault().addResponse(
             {"message": "Deleted contents of folder %s." % path.name}
         )
@@ -176,6 +297,7 @@ class VirtualFolder(VirtualObject):
 
         new_path = ensure_unique_path(dst_path, name)
         shutil.copytree(path.as_posix(), new_path.as_posix())
+        notify_changed(new_path)
         event.preventDefault().addResponse(
             Folder().filter(self.vFolder(new_path, dst_root), user=user)
         )
@@ -184,35 +306,120 @@ class VirtualFolder(VirtualObject):
     @validate_event(level=AccessType.READ)
     def get_folder_details(self, event, path, root, user=None):
         self.is_dir(path, root["_id"])
-        response = dict(nFolders=0, nItems=0)
-        for obj in path.iterdir():
-            if obj.is_dir():
-                response["nFolders"] += 1
-            elif obj.is_file():
-                response["nItems"] += 1
+        self.check_listing(
+            path, root, user, event.info["params"], folder_sizes.version(path)
+        )
+        n_folders, n_items = self.count_children(path, root)
+        response = dict(nFolders=n_folders, nItems=n_items)
+        total = folder_sizes.get(path)
+        if total is not None:
+            response.update(size=total.size, nFilesRecursive=total.nFiles)
         event.preventDefault().addResponse(response)
 
     @access.public(scope=TokenScope.DATA_READ)
     @validate_event(level=AccessType.READ)
     def download_folder(self, event, path, root, user=None):
         self.is_dir(path, root["_id"])
+        params = event.info["params"]
+        options = zip_params(params)
+        archive = archive_format(params)
+        if archive == "zip" and options["compression"] == "store":
+            return self._download_stored(event, path)
+
+        if archive == "zip":
+            zip_stream = ZipStream(**options)
+            key_options = (archive, options["compression"], options["level"])
+
+            def generate():
+                files = ReadAhead(walk_files(path), path=lambda item: item[0].path)
+                return zip_stream.generate(files)
+
+            def tree():
+                return ((name, entry.stat()) for entry, name in walk_files(path))
+
+        else:
+            try:
+                tar_stream = TarStream(ARCHIVE_FORMATS[archive], options["level"])
+            except ValueError as exc:
+                raise ValidationException(str(exc), "format")
+            key_options = (archive, options["level"])
+
+            def generate():
+                return tar_stream.generate(tar_files(path))
+
+            def tree():
+                return ((name, stat) for _, name, stat in walk_tree(path))
+
+        setResponseHeader("Content-Type", ARCHIVE_CONTENT_TYPES[archive])
+        setContentDisposition(path.name + "." + archive)
+        if not archive_cache.enabled:
+            event.preventDefault().addResponse(generate)
+            return
+
+        def current_key():
+            return archive_cache.key(path, root["_id"], tree(), *key_options)
+
+        key = current_key()
+        check_not_modified('"%s"' % key)
+        cached = archive_cache.lookup(key)
+        if cached is not None:
+            return self._download_cached(event, cached)
+
+        def stream():
+            return archive_cache.store(key, path, generate(), current_key)
+
+        event.preventDefault().addResponse(stream)
+
+    @staticmethod
+    def _download_cached(event, cached):
+        size = cached.stat().st_size
+        setResponseHeader("Content-Length", size)
+        if sendfile_offload.enabled:
+            headers = sendfile_offload.headers(cached)
+            if headers:
+                for key, value in headers.items():
+                    setResponseHeader(key, value)
+                event.preventDefault().addResponse(lambda: iter(()))
+                return
+
+        def stream():
+            return read_range(cached, 0, size)
+
+        event.preventDefault().addResponse(stream)
+
+    def _download_stored(self, event, path):
+        """
+        Uncompressed archive with a known size, which supports ``Range`` so
+        that interrupted downloads can be resumed.
+        """
+        archive = StoredZip(walk_files(path))
+        # Dates are no validators here: a rename changes the layout of the
+        # archive, but not the mtime of its newest file
+        check_not_modified(archive.etag)
+        setResponseHeader("Accept-Ranges", "bytes")
+
+        ranges = None
+        if range_applies(archive.etag):
+            ranges = cherrypy.lib.httputil.get_ranges(
+                cherrypy.request.headers.get("Range"), archive.size
+            )
+        if ranges == []:
+            setResponseHeader("Content-Range", "bytes */%d" % archive.size)
+            raise RestException("Requested range not satisfiable.", code=416)
         setResponseHeader("Content-Type", "application/zip")
         setContentDisposition(path.name + ".zip")
+        # Multiple ranges aren't worth it for an archive, they get the whole of it
+        if ranges and len(ranges) == 1:
+            start, end = ranges[0]
+            setResponseHeader(
+                "Content-Range", "bytes %d-%d/%d" % (start, end - 1, archive.size)
+            )
+        else:
+            start, end = 0, archive.size
+        setResponseHeader("Content-Length", end - start)
 
         def stream():
-            def recursive_file_list(p):
-                for obj in p.iterdir():
-                    if obj.is_file():
-                        yield obj
-                    elif obj.is_dir():
-                        yield from recursive_file_list(obj)
-
-            zip_stream = ziputil.ZipGenerator(rootPath="")
-            for obj in recursive_file_list(path):
-                zip_path = os.path.relpath(obj.as_posix(), path.as_posix())
-                for data in zip_stream.addFile(lambda: file_stream(obj), zip_path):
-                    yield data
-            yield zip_stream.footer()
+            return archive.generate(start, end)
 
         event.preventDefault().addResponse(stream)
 
@@ -250,6 +457,7 @@ class VirtualFolder(VirtualObject):
         self.is_dir(path, root["_id"])
         new_folder = path / event.info["params"]["path"]
         new_folder.mkdir(parents=True, exist_ok=True)
+        notify_changed(path)
         event.preventDefault().addResponse(
             Folder().filter(self.vFolder(new_folder, root), user=user)
         )
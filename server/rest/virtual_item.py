@@ -1,20 +1,28 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from operator import itemgetter
 import os
 import pathlib
-import pymongo
 import shutil
 
 from girder import events
 from girder.api import access
+from girder.api.rest import setResponseHeader
 from girder.constants import TokenScope, AccessType
 from girder.exceptions import GirderException, ValidationException
 from girder.models.file import File
 from girder.models.folder import Folder
 from girder.models.item import Item
+from girder.utility import toBool
 
-from . import VirtualObject, validate_event, ensure_unique_path, bail_if_exists
+from . import (
+    VirtualObject,
+    validate_event,
+    ensure_unique_path,
+    bail_if_exists,
+    notify_changed,
+    filter_children,
+)
+from .checksums import checksums
 
 
 class VirtualItem(VirtualObject):
@@ -39,25 +47,36 @@ class VirtualItem(VirtualObject):
     def get_child_items(self, event, path, root, user=None):
         self.is_dir(path, root["_id"])
         params = event.info["params"]
-        offset = int(params.get("offset", 0))
-        limit = int(params.get("limit", 50))
-        name = params.get("name")
-        sort_key = params.get("sort", "lowerName")
-        reverse = int(params.get("sortdir", pymongo.ASCENDING)) == pymongo.DESCENDING
-
-        if name:
-            if (path / name).is_file():
-                items = [self.vItem(path / name, root)]
-            else:
-                items = []
-        else:
-            items = [self.vItem(obj, root) for obj in path.iterdir() if obj.is_file()]
-        items = sorted(items, key=itemgetter(sort_key), reverse=reverse)
-        upper_bound = limit + offset if limit > 0 else None
-        response = [
-            Item().filter(item, user=user) for item in items[offset:upper_bound]
-        ]
-        event.preventDefault().addResponse(response)
+        with_checksums = toBool(params.get("checksums", False))
+        if not with_checksums:
+            self.check_listing(path, root, user, params)
+
+        # Only checksums known already, the others are computed in the background
+        known = {}
+
+        def make_doc(entry):
+            doc = self.vItem(pathlib.Path(entry.path), root, stat=entry.stat())
+            if with_checksums:
+                known[doc["_id"]] = checksums.get(entry.path, entry.stat())
+            return doc
+
+        items, next_cursor = self.list_children(
+            path, root, params, make_doc, folders=False
+        )
+        if with_checksums:
+            # Validated once the page is built: that is when files changed in
+            # place are queued for hashing, and which checksums are known
+            # depends on the page only, not on the process answering
+            self.check_listing(
+                path, root, user, params,
+                sorted((_id, sorted(known[_id].items())) for _id in known),
+            )
+        if next_cursor:
+            setResponseHeader("Girder-Next-Cursor", next_cursor)
+        items = filter_children(Item(), items, user)
+        for doc in items:
+            doc.update(known.get(doc["_id"], {}))
+        event.preventDefault().addResponse(items)
 
     @access.user(scope=TokenScope.DATA_WRITE)
     @validate_event(level=AccessType.WRITE)
@@ -72,6 +91,7 @@ class VirtualItem(VirtualObject):
             raise ValidationException(
                 "An item with that name already exists here.", "name"
             )
+        notify_changed(new_path)
         event.preventDefault().addResponse(
             Item().filter(self.vItem(new_path, root), user=user)
         )
@@ -107,6 +127,7 @@ class VirtualItem(VirtualObject):
             new_path = dst_path / name
             bail_if_exists(new_path)
             shutil.move(path.as_posix(), new_path.as_posix())
+        notify_changed(path, new_path)
 
         event.preventDefault().addResponse(
             Item().filter(self.vItem(new_path, root), user=user)
@@ -117,6 +138,7 @@ class VirtualItem(VirtualObject):
     def remove_item(self, event, path, root, user=None):
         self.is_file(path, root["_id"])
         path.unlink()
+        notify_changed(path)
         event.preventDefault().addResponse({"message": "Deleted item %s." % path.name})
 
     @access.user(scope=TokenScope.DATA_WRITE)
@@ -146,6 +168,7 @@ class VirtualItem(VirtualObject):
 
         new_path = ensure_unique_path(new_dirname, name)
         shutil.copy(path.as_posix(), new_path.as_posix())
+        notify_changed(new_path)
         event.preventDefault().addResponse(
             Item().filter(self.vItem(new_path, new_root), user=user)
         )
@@ -1,14 +1,19 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import calendar
 import json
 from operator import itemgetter
 import os
 import pathlib
 import shutil
+import stat as stat_module
+import time
 
 from girder import events
 
 from girder.api import access
+from girder.api.describe import Description, autoDescribeRoute
+from girder.api.rest import setResponseHeader, setContentDisposition
 from girder.constants import AccessType, TokenScope
 from girder.exceptions import (
     AccessException,
@@ -17,13 +22,58 @@ from girder.exceptions import (
     RestException,
 )
 from girder.models.collection import Collection
+from girder.models.file import File
 from girder.models.folder import Folder
+from girder.models.item import Item
 from girder.models.user import User
+from girder.utility import toBool
 from girder.utility.path import lookUpToken, split, getResourcePath
 from girder.utility.model_importer import ModelImporter
 from girder.utility.progress import ProgressContext
 
-from . import VirtualObject, validate_event, ensure_unique_path
+from . import (
+    VirtualObject,
+    validate_event,
+    ensure_unique_path,
+    notify_changed,
+    load_root,
+)
+from .archive import (
+    ARCHIVE_CONTENT_TYPES,
+    ARCHIVE_FORMATS,
+    TarStream,
+    ZipStream,
+    content_stat,
+    read_records,
+    walk_files,
+    walk_tree,
+)
+from .archive_cache import archive_cache
+from .checksums import checksums
+from .listing import listing_cache
+from .sizes import folder_sizes
+from .virtual_folder import archive_format, zip_params
+
+DOWNLOAD_KINDS = ("collection", "user", "folder", "item")
+
+
+def _girder_file(name, file):
+    """Archive record of a file stored in a Girder assetstore."""
+    created = file.get("updated") or file.get("created")
+    mtime = calendar.timegm(created.utctimetuple()) if created else int(time.time())
+
+    def source():
+        return File().download(file, headers=False)()
+
+    return None, name, content_stat(file.get("size") or 0, mtime), source
+
+
+def _generated_file(name, stream):
+    """Archive record of content generated by Girder, such as metadata files."""
+    data = b"".join(
+        chunk.encode("utf-8") if isinstance(chunk, str) else chunk for chunk in stream()
+    )
+    return None, name, content_stat(len(data), int(time.time())), lambda: [data]
 
 
 class EmptyDocument(Exception):
@@ -41,11 +91,28 @@ class VirtualResource(VirtualObject):
         events.bind("rest.get.resource/:id/path.before", name, self.path)
         # PUT /resource/:id/timestamp
         events.bind("rest.post.resource/copy.before", name, self.copy_resources)
-        # GET /resource/:id/download
+        events.bind("rest.get.resource/download.before", name, self.download_resources)
+        events.bind("rest.post.resource/download.before", name, self.download_resources)
         events.bind("rest.get.resource/lookup.before", name, self.lookup)
         events.bind("rest.put.resource/move.before", name, self.move_resources)
         # GET /resource/search
 
+        self.route("GET", ("cache",), self.cache_stats)
+
+    @access.admin
+    @autoDescribeRoute(
+        Description(
+            "Get usage statistics of the virtual resources caches."
+        ).errorResponse("Admin access was denied.", 403)
+    )
+    def cache_stats(self):
+        return {
+            "listing": listing_cache.stats(),
+            "folderSizes": folder_sizes.stats(),
+            "archives": archive_cache.stats(),
+            "checksums": checksums.stats(),
+        }
+
     def _filter_resources(self, event, level=AccessType.WRITE, user=None):
         resources = json.loads(event.info["params"]["resources"])
         remaining_resources = dict(folder=[], item=[])
@@ -89,6 +156,7 @@ class VirtualResource(VirtualObject):
                     shutil.rmtree(source_path.as_posix())
                 else:
                     source_path.unlink()
+                notify_changed(source_path)
                 ctx.update(increment=1)
 
     @access.user(scope=TokenScope.DATA_WRITE)
@@ -107,13 +175,13 @@ class VirtualResource(VirtualObject):
                 source_path = obj["src_path"]
                 ctx.update(message="Copying %s %s" % (obj["kind"], source_path.name))
                 if obj["kind"] == "folder":
-                    shutil.copytree(
-                        source_path.as_posix(), (path / source_path.name).as_posix()
-                    )
+                    new_path = path / source_path.name
+                    shutil.copytree(source_path.as_posix(), new_path.as_posix())
                 else:
                     name = source_path.name
                     new_path = ensure_unique_path(path, name)
                     shutil.copy(source_path.as_posix(), new_path.as_posix())
+                notify_changed(new_path)
                 ctx.update(increment=1)
 
     @access.user(scope=TokenScope.DATA_WRITE)
@@ -131,11 +199,145 @@ class VirtualResource(VirtualObject):
             for obj in wt_resources:
                 source_path = obj["src_path"]
                 ctx.update(message="Moving %s %s" % (obj["kind"], source_path.name))
-                shutil.move(
-                    source_path.as_posix(), (path / source_path.name).as_posix()
-                )
+                new_path = path / source_path.name
+                shutil.move(source_path.as_posix(), new_path.as_posix())
+                notify_changed(source_path, new_path)
                 ctx.update(increment=1)
 
+    @access.cookie
+    @access.public(scope=TokenScope.DATA_READ)
+    def download_resources(self, event):
+        """
+        Stream a single archive of a selection with virtual resources in it,
+        which may also contain regular Girder resources. Selections without
+        virtual resources are left to Girder.
+        """
+        params = event.info["params"]
+        try:
+            resources = json.loads(params["resources"])
+            selection = [(kind, obj_id) for kind in resources for obj_id in resources[kind]]
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return  # Girder reports malformed selections
+        if not any(
+            kind in ("folder", "item") and self.path_from_id(obj_id)[0]
+            for kind, obj_id in selection
+        ):
+            return
+        user = self.getCurrentUser()
+        documents = self._download_selection(selection, user)
+
+        options = zip_params(params)
+        archive = archive_format(params)
+        include_metadata = toBool(params.get("includeMetadata", False))
+        if archive == "zip":
+            archive_stream = ZipStream(**options)
+        else:
+            try:
+                archive_stream = TarStream(ARCHIVE_FORMATS[archive], options["level"])
+            except ValueError as exc:
+                raise ValidationException(str(exc), "format")
+        setResponseHeader("Content-Type", ARCHIVE_CONTENT_TYPES[archive])
+        setContentDisposition("Resources." + archive)
+
+        def records():
+            for kind, path, doc in documents:
+                if path is not None:
+                    # Mapping roots are named after their folder, as in Girder
+                    name = doc["name"] if doc is not None else path.name
+                    yield from self._local_records(path, name, archive)
+                else:
+                    yield from self._girder_records(
+                        kind, doc, "", user, include_metadata, archive
+                    )
+
+        def stream():
+            return archive_stream.generate(read_records(records(), archive))
+
+        event.preventDefault().addResponse(stream)
+
+    def _download_selection(self, selection, user):
+        """
+        Check the whole selection before streaming, so that an error doesn't
+        cut the archive short.
+
+        :returns: a list of ``(kind, path, document)``, with either a path on
+            disk or a Girder document, or both for a mapping root.
+        """
+        documents = []
+        for kind, obj_id in selection:
+            if kind not in DOWNLOAD_KINDS:
+                raise RestException("Invalid resource types requested: %s" % kind)
+            path, root = (None, None)
+            if kind in ("folder", "item"):
+                path, root_id = self.path_from_id(obj_id)
+                if path:
+                    root = load_root(root_id, AccessType.READ, user)
+            if root is not None:
+                if kind == "folder":
+                    self.is_dir(path, root["_id"])
+                else:
+                    self.is_file(path, root["_id"])
+                is_root = path == pathlib.Path(root["fsPath"])
+                documents.append((kind, path, root if is_root else None))
+            else:
+                doc = ModelImporter.model(kind).load(
+                    obj_id, user=user, level=AccessType.READ
+                )
+                if doc is None:
+                    raise RestException("Resource %s %s not found." % (kind, obj_id))
+                documents.append((kind, None, doc))
+        return documents
+
+    @staticmethod
+    def _local_records(path, name, archive):
+        """Archive records of a file or a directory tree on disk."""
+        if archive == "zip":
+            if path.is_dir():
+                for entry, rel in walk_files(path):
+                    yield entry.path, name + "/" + rel, entry.stat(), None
+            else:
+                yield path.as_posix(), name, path.stat(), None
+            return
+        stat = path.lstat()
+        yield path.as_posix(), name, stat, None
+        if stat_module.S_ISDIR(stat.st_mode):
+            for child, rel, child_stat in walk_tree(path):
+                yield child, name + "/" + rel, child_stat, None
+
+    def _girder_records(self, kind, doc, prefix, user, include_metadata, archive):
+        """
+        Archive records of a Girder resource, laid out like Girder's own
+        downloads. Mapped folders found on the way are read from disk.
+        """
+        if kind == "item":
+            for name, file in Item().fileList(
+                doc, user=user, path=prefix, includeMetadata=include_metadata,
+                subpath=True, data=False,
+            ):
+                yield _generated_file(name, file) if callable(file) else _girder_file(name, file)
+            return
+        if doc.get("fsPath"):
+            path = pathlib.Path(doc["fsPath"])
+            if path.is_dir():
+                yield from self._local_records(path, os.path.join(prefix, doc["name"]), archive)
+            return
+
+        prefix = os.path.join(prefix, doc["login"] if kind == "user" else doc["name"])
+        for folder in Folder().childFolders(parentType=kind, parent=doc, user=user):
+            yield from self._girder_records(
+                "folder", folder, prefix, user, include_metadata, archive
+            )
+        if kind == "folder":
+            for item in Folder().childItems(folder=doc):
+                yield from self._girder_records(
+                    "item", item, prefix, user, include_metadata, archive
+                )
+            if include_metadata and doc.get("meta"):
+                yield _generated_file(
+                    os.path.join(prefix, "girder-folder-metadata.json"),
+                    lambda: [json.dumps(doc["meta"], default=str)],
+                )
+
     @access.public(scope=TokenScope.DATA_READ)
     @validate_event(level=AccessType.READ)
     def path(self, event, path, root, user=None):